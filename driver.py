@@ -1,10 +1,13 @@
 #!/usr/bin/env python3
 
 import argparse
+import collections
 import io
 import multiprocessing as mp
 import os
+import queue
 import random
+import signal
 import sys
 
 import mtg
@@ -13,37 +16,273 @@ def main(args):
     # If reporting results, do so.
     if args.results:
         return mtg.print_results(args.decks)
-    # If given multiple names, choose randomly each time.
-    trial = 0
-    while True:
+    if args.import_json:
+        return mtg.import_json(args.decks)
+    if args.benchmark:
+        if not mtg.benchmark.run(args.search, args.save_baseline, numpy=args.numpy):
+            sys.exit(1)
+        return
+    # Instrumentation counts from every trial get added up here.
+    totals = mtg.stats.Totals()
+    if args.stats:
+        mtg.instrument()
+    if args.numpy:
+        mtg.vector.enable()
+    try:
+        if args.stratified:
+            return run_stratified(args, totals)
+        if args.paired:
+            return run_paired(args, totals)
         if args.jobs > 1:
-            batch_size = 10*args.jobs
-            pool = mp.Pool(processes=args.jobs)
-            jobs = []
-            for _ in range(batch_size):
-                trial += 1
-                name = random.choice(args.decks)
-                jobs.append(
-                    pool.apply_async(mtg.simulate, (name, trial, args.turns))
+            return run_parallel(args, totals)
+        scheduler = make_scheduler(args)
+        todo = trials(args, scheduler)
+        retries = collections.deque()
+        while True:
+            task = next_task(todo, retries)
+            if task is None:
+                return
+            task, summary, report, counts = simulate(task)
+            totals.add(counts)
+            if requeue(task, summary, retries):
+                continue
+            if scheduler:
+                scheduler.record(task["name"], summary)
+            if report and args.debug:
+                print(report)
+                return
+    finally:
+        # Workers have all exited by now, so their shards are finished.
+        for name in args.decks:
+            mtg.output.compact(name)
+        if args.stats:
+            print()
+            mtg.stats.print_summary(totals.counts)
+            print("wrote", mtg.stats.write_report(totals))
+
+
+def run_parallel(args, totals):
+    """Keep one pool around for the whole run. Hands take wildly different
+    amounts of time, so rather than waiting on batches, we keep a couple of
+    trials queued up per worker and hand out a new one whenever one
+    finishes.
+    """
+    # Make sure the deck lists load before handing them off. If a worker
+    # fails in its initializer, the pool just keeps replacing it.
+    mtg.load_decks(args.decks)
+    results = queue.Queue()
+    pool = mp.Pool(
+        processes=args.jobs,
+        initializer=init_worker,
+        initargs=(args.decks, args.stats, args.numpy),
+    )
+    pending = 0
+    scheduler = make_scheduler(args)
+    todo = trials(args, scheduler)
+    retries = collections.deque()
+    try:
+        while True:
+            while pending < 2*args.jobs:
+                task = next_task(todo, retries)
+                if task is None:
+                    break
+                pool.apply_async(
+                    simulate,
+                    (task,),
+                    callback=results.put,
+                    error_callback=results.put,
                 )
-            results = [x.get() for x in jobs]
-            if any(results) and args.debug:
-                for result in results:
-                    if not result:
-                        continue
-                    print(result)
-                    return
-            if args.ntrials and trial >= args.ntrials:
+                pending += 1
+            if not pending:
+                break
+            result = results.get()
+            pending -= 1
+            if isinstance(result, BaseException):
+                raise result
+            task, summary, report, counts = result
+            totals.add(counts)
+            if requeue(task, summary, retries):
+                continue
+            if scheduler:
+                scheduler.record(task["name"], summary)
+            if report and args.debug:
+                print(report)
                 return
+        pool.close()
+    finally:
+        # Anything still running is either done with or no longer wanted.
+        pool.terminate()
+        pool.join()
+
+
+def init_worker(decks, instrument=False, numpy=False):
+    mtg.load_decks(decks)
+    if instrument:
+        mtg.instrument()
+    if numpy:
+        mtg.vector.enable()
+    # When the pool gets terminated, exit cleanly so that buffered results
+    # get written out.
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+
+
+def run_stratified(args, totals):
+    """Go through each deck in turn. Tasks all get handed out up front, and
+    results come back in order, since the error estimate cares which hands
+    were next to each other.
+    """
+    ntrials = args.ntrials or 1000
+    mtg.load_decks(args.decks)
+    estimates = {}
+    pool = None
+    if args.jobs > 1:
+        pool = mp.Pool(
+            processes=args.jobs,
+            initializer=init_worker,
+            initargs=(args.decks, args.stats, args.numpy),
+        )
+    try:
+        for name in args.decks:
+            cardnames, _ = mtg.manager.read_deck(name)
+            tasks = [
+                (name, hand, on_the_play, *search_args(args))
+                for hand, on_the_play in mtg.stratified.plan(cardnames, ntrials)
+            ]
+            if pool:
+                results = pool.map(stratified_trial, tasks, chunksize=1)
+            else:
+                results = [stratified_trial(x) for x in tasks]
+            estimates[name] = []
+            for summary, counts in results:
+                totals.add(counts)
+                estimates[name].append(summary)
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+    print()
+    header = "name".ljust(12)
+    for turn in range(1, args.turns + 1):
+        header += f"| turn {turn} ".ljust(18)
+    print(header)
+    for name, summaries in estimates.items():
+        mtg.stratified.print_estimates(name, summaries, args.turns)
+
+
+def run_paired(args, totals):
+    """Run every deck against the same sequence of shuffles, then compare
+    them trial by trial.
+    """
+    ntrials = args.ntrials or 1000
+    mtg.load_decks(args.decks)
+    first_seed = random.randrange(10**6)
+    tasks = [
+        (name, seed, *search_args(args))
+        for seed in range(first_seed, first_seed + ntrials)
+        for name in args.decks
+    ]
+    pool = None
+    if args.jobs > 1:
+        pool = mp.Pool(
+            processes=args.jobs,
+            initializer=init_worker,
+            initargs=(args.decks, args.stats, args.numpy),
+        )
+    try:
+        if pool:
+            results = pool.map(paired_trial, tasks, chunksize=1)
+            pool.close()
         else:
-            trial += 1
-            name = random.choice(args.decks)
-            result = mtg.simulate(name, trial, args.turns)
-            if result and args.debug:
-                print(result)
-                return
-            if args.ntrials and trial >= args.ntrials:
+            results = [paired_trial(x) for x in tasks]
+        summaries = []
+        for summary, counts in results:
+            totals.add(counts)
+            summaries.append(summary)
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+    results = {name: summaries[i::len(args.decks)] for i, name in enumerate(args.decks)}
+    print()
+    mtg.paired.print_differences(results, args.turns)
+
+
+def search_args(args):
+    """How to search each hand, for runs that pass tasks as tuples."""
+    return (
+        args.turns,
+        args.search,
+        not args.no_cache,
+        args.max_states,
+        args.max_seconds,
+        args.retries,
+    )
+
+
+def simulate(task):
+    summary, report = mtg.simulate(**task)
+    return task, summary, report, mtg.stats.take()
+
+
+def stratified_trial(task):
+    return mtg.stratified.trial(task), mtg.stats.take()
+
+
+def paired_trial(task):
+    return mtg.paired.trial(task), mtg.stats.take()
+
+
+def next_task(todo, retries):
+    """Hands waiting to be retried go ahead of new ones."""
+    if retries:
+        return retries.popleft()
+    return next(todo, None)
+
+
+def requeue(task, summary, retries):
+    """If this hand overflowed and has retries left, send it to the back of
+    the line with a bigger budget.
+    """
+    if mtg.manager.overflowed(summary) and task["tier"] < task["retries"]:
+        retries.append(dict(task, tier=task["tier"] + 1))
+        return True
+    return False
+
+
+def make_scheduler(args):
+    if args.target is None:
+        return None
+    return mtg.Scheduler(args.decks, args.turns, args.target/100)
+
+
+def trials(args, scheduler=None):
+    """If given multiple names, choose randomly each time. Or, if we have a
+    target, let the scheduler decide, and stop once it says we're done.
+    """
+    trial = 0
+    while not args.ntrials or trial < args.ntrials:
+        trial += 1
+        if scheduler:
+            name = scheduler.choose()
+            if name is None:
                 return
+        else:
+            name = random.choice(args.decks)
+        yield {
+            "name": name,
+            "trial": trial,
+            "max_turns": args.turns,
+            "search": args.search,
+            "use_cache": not args.no_cache,
+            # Each shuffle comes from its own seed, so that it can be played
+            # again if it needs a retry.
+            "seed": random.randrange(2**32),
+            "max_states": args.max_states,
+            "max_seconds": args.max_seconds,
+            "tier": 0,
+            "retries": args.retries,
+            "workers": args.workers,
+        }
 
 
 def all_decks():
@@ -61,6 +300,11 @@ def parse_args():
         help="Deck name(s) to look at",
         default=all_decks(),
     )
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="Play through the fixed hands in benchmark/corpus.json and compare against the saved baseline. Fails if any outcome changes or if it's gotten much slower",
+    )
     parser.add_argument(
         "-d",
         "--debug",
@@ -74,17 +318,80 @@ def parse_args():
         default=1,
         help="Run in parallel using this many threads",
     )
+    parser.add_argument(
+        "--max-seconds",
+        type=float,
+        help="Also give up on a hand after this long. Depends on the machine, so results may not be reproducible (default: no limit)",
+    )
+    parser.add_argument(
+        "--max-states",
+        type=int,
+        default=mtg.budget.MAX_STATES,
+        help="Give up on a hand (and call it an overflow) after building this many states (default: %(default)s)",
+    )
     parser.add_argument(
         "-n",
         "--ntrials",
         type=int,
         help="Stop after this many trials (default: run until killed)",
     )
+    parser.add_argument(
+        "--import-json",
+        action="store_true",
+        help="Convert results saved as JSON by older versions, so that --results includes them",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Search every hand from scratch, even ones we've seen before",
+    )
+    parser.add_argument(
+        "--numpy",
+        action="store_true",
+        help="Prune each turn's states with NumPy array operations rather than one pair at a time. Helps with big turn 3 and 4 searches. With --benchmark, check that it keeps the same states instead. Needs NumPy",
+    )
+    parser.add_argument(
+        "--paired",
+        action="store_true",
+        help="Give every deck the same sequence of shuffles, then print how each deck compares to the first one (default: 1000 trials per deck)",
+    )
     parser.add_argument(
         "--results",
         action="store_true",
         help="Instead of running simulations, print the results for the given decks",
     )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=0,
+        help="Give hands that overflow this many more tries, each with %d times the budget of the last (default: 0)" % mtg.budget.GROWTH,
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="With --benchmark, save the timings as the new baseline",
+    )
+    parser.add_argument(
+        "--search",
+        choices=("bfs", "dfs"),
+        default="bfs",
+        help="Breadth-first builds out every state for each turn. Depth-first stops at the first solution (default: bfs)",
+    )
+    parser.add_argument(
+        "--stratified",
+        action="store_true",
+        help="Rather than shuffling at random, spread trials evenly over all possible opening hands, then print estimates for each deck (default: 1000 trials per deck)",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="Count how many states each card and action generates, and write a report to stats/ at the end of the run",
+    )
+    parser.add_argument(
+        "--target",
+        type=float,
+        help="Keep running each deck until its error bars (as shown by --results) are within this many percent, then stop. Trials go to whichever decks need them most",
+    )
     parser.add_argument(
         "--turns",
         "-t",
@@ -92,7 +399,23 @@ def parse_args():
         help="Maximum number of turns to simulate (default: 3)",
         default=3,
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="Split each hand's breadth-first search across this many processes. Meant for looking at one hand at a time, so it can't be combined with --jobs",
+    )
+    args = parser.parse_args()
+    # Pool workers aren't allowed to start pools of their own.
+    if args.workers > 1 and args.jobs > 1:
+        parser.error("--workers and --jobs can't be combined")
+    if args.numpy and not mtg.vector.available():
+        parser.error("--numpy needs NumPy, which isn't installed")
+    # Checking the pruning is slow, so the timings wouldn't mean anything.
+    if args.numpy and args.save_baseline:
+        parser.error("--save-baseline can't be combined with --numpy")
+    return args
 
 
 class SilenceStderr(object):
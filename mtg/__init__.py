@@ -1,2 +1,5 @@
-from .manager import simulate
-from .output import print_results
+from .manager import load_decks, simulate
+from .output import import_json, print_results
+from .schedule import Scheduler
+from .state import instrument
+from . import benchmark, budget, frontier, paired, stats, stratified, vector
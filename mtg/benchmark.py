@@ -0,0 +1,172 @@
+"""
+A frozen set of hands to measure engine changes against. Each hand in
+benchmark/corpus.json has the deck in exact order, play/draw, how many
+turns to look at, and the outcome we expect from each search mode. The
+corpus covers easy hands, slow whiffs, hands that overflow, and turn-4
+searches.
+
+Running the benchmark plays each hand in a fresh process (so that peak
+memory is per hand) and records wall time, number of states, and peak
+memory. Outcomes have to match the corpus exactly. Timings get compared
+against benchmark/baseline.json, which is specific to the machine it was
+made on. Save one with --save-baseline before making changes.
+
+With numpy=True (--benchmark --numpy), every frontier gets pruned both
+with and without arrays, and any disagreement is a failure. That's slow,
+so timings don't get compared or saved.
+"""
+
+import contextlib
+import io
+import json
+import multiprocessing as mp
+import os
+import random
+import resource
+import time
+
+from . import budget, helpers, manager, vector
+
+CORPUS = os.path.join("benchmark", "corpus.json")
+BASELINE = os.path.join("benchmark", "baseline.json")
+# How much slower can the whole corpus get before we call it a regression?
+THRESHOLD = 0.25
+
+
+def shuffle(name, seed):
+    cardnames, kwargs = manager.read_deck(name)
+    rng = random.Random(seed)
+    on_the_play = bool(rng.randrange(2))
+    deck_list = list(cardnames)
+    rng.shuffle(deck_list)
+    return deck_list, dict(kwargs), on_the_play
+
+
+def freeze(specs, searches=("bfs", "dfs")):
+    """Write out a corpus. Each spec is (label, deck name, seed, turns).
+    Expected outcomes come from running the current engine, so look them
+    over before committing.
+    """
+    hands = []
+    for label, name, seed, max_turns in specs:
+        deck_list, kwargs, on_the_play = shuffle(name, seed)
+        hand = {
+            "label": label,
+            "name": name,
+            "seed": seed,
+            "max_turns": max_turns,
+            "on_the_play": on_the_play,
+            "kwargs": kwargs,
+            "deck_list": deck_list,
+            "expected": {},
+        }
+        for search in searches:
+            hand["expected"][search] = measure(hand, search)["summary"]
+        hands.append(hand)
+    os.makedirs(os.path.dirname(CORPUS), exist_ok=True)
+    with open(CORPUS, "w") as handle:
+        json.dump(hands, handle, indent=1)
+    return
+
+
+def measure(hand, search, numpy=False):
+    """Play a single hand in a process of its own."""
+    with mp.Pool(processes=1, maxtasksperchild=1) as pool:
+        return pool.apply(play, (hand, search, numpy))
+
+
+def play(hand, search, numpy=False):
+    if numpy:
+        vector.enable(check=True)
+    start = time.perf_counter()
+    search_budget = budget.Budget()
+    # Overflows print the longest line they found. Not useful here.
+    with contextlib.redirect_stdout(io.StringIO()):
+        summary, report, performance = manager.play(
+            hand["deck_list"],
+            dict(hand["kwargs"]),
+            hand["on_the_play"],
+            hand["max_turns"],
+            search,
+            use_cache=False,
+            budget=search_budget,
+        )
+    return {
+        "summary": summary,
+        "seconds": time.perf_counter() - start,
+        "states": search_budget.states,
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def key(hand):
+    return f"{hand['label']}/{hand['name']}/{hand['seed']}"
+
+
+def run(search="bfs", save_baseline=False, threshold=THRESHOLD, numpy=False):
+    """Play through the corpus. Return True if everything checks out."""
+    with open(CORPUS, "r") as handle:
+        hands = json.load(handle)
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE, "r") as handle:
+            baseline = json.load(handle).get(search, {})
+    results = {}
+    ok = True
+    for hand in hands:
+        try:
+            result = measure(hand, search, numpy)
+        except AssertionError as error:
+            print("%-12s %-10s %-4s %s %s" % (
+                hand["label"],
+                hand["name"],
+                hand["seed"],
+                helpers.highlight("PRUNING CHANGED", "red"),
+                error,
+            ))
+            ok = False
+            continue
+        results[key(hand)] = result
+        expected = hand["expected"][search]
+        line = "%-12s %-10s %-4s %s %6.0fk states %6.1f s %6.0f MB" % (
+            hand["label"],
+            hand["name"],
+            hand["seed"],
+            manager.summarize(result["summary"]),
+            result["states"]/1000,
+            result["seconds"],
+            result["max_rss_kb"]/1024,
+        )
+        old = baseline.get(key(hand))
+        if old:
+            line += " (was %6.1f s)" % old["seconds"]
+        if result["summary"] != expected:
+            line += " " + helpers.highlight("OUTCOME CHANGED", "red")
+            ok = False
+        print(line)
+    seconds = sum(x["seconds"] for x in results.values())
+    states = sum(x["states"] for x in results.values())
+    print("total %.0fk states in %.1f s" % (states/1000, seconds))
+    if numpy:
+        return ok
+    old = [baseline[x] for x in results if x in baseline]
+    if old and len(old) == len(results):
+        old_seconds = sum(x["seconds"] for x in old)
+        print("baseline %.0fk states in %.1f s" % (
+            sum(x["states"] for x in old)/1000,
+            old_seconds,
+        ))
+        if seconds > (1 + threshold)*old_seconds:
+            print(helpers.highlight("slower than baseline", "red"))
+            ok = False
+    elif not save_baseline:
+        print("no baseline to compare against, use --save-baseline")
+    if save_baseline:
+        saved = {}
+        if os.path.exists(BASELINE):
+            with open(BASELINE, "r") as handle:
+                saved = json.load(handle)
+        saved[search] = results
+        with open(BASELINE, "w") as handle:
+            json.dump(saved, handle, indent=1)
+    return ok
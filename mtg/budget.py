@@ -0,0 +1,67 @@
+"""
+Each search gets a Budget. It caps how many game states the search can
+build, which doesn't depend on how fast the machine is or how many other
+jobs are running, so a hand that overflows on one machine overflows on all
+of them. An optional time limit goes on top of that.
+
+The budget also keeps the search's counters: states built, repeats skipped,
+states dominated, and how far into the deck we've looked. Every GameState
+holds on to the budget of the search it belongs to, so more than one search
+can run in the same process. Since it's shared anyway, it's also where the
+search keeps its deck list, which never changes.
+"""
+
+import time
+
+# Most of the hands that don't converge at 2e5 states also don't
+# converge at 5e5 states. How much time do you want to burn trying?
+MAX_STATES = 200000
+# Each retry of a hand that overflowed gets this many times the budget of
+# the last try.
+GROWTH = 4
+
+
+class Budget(object):
+
+    def __init__(self, max_states=MAX_STATES, max_seconds=None):
+        self.max_states = max_states
+        self.max_seconds = max_seconds
+        self.start_time = time.time()
+        self.states = 0
+        # How many times the closed set saved us from expanding a state again
+        self.repeats = 0
+        # How many states we dropped because another state was at least as good
+        self.dominated = 0
+        # How far into the deck the search has looked. The outcome depends
+        # on the deck's order only up to here.
+        self.deepest = 0
+        # Set when the search starts.
+        self.deck_list = ()
+
+    @classmethod
+    def for_tier(cls, tier, max_states=MAX_STATES, max_seconds=None):
+        """Budget for the given retry. Zero is the first try."""
+        scale = GROWTH**tier
+        if max_seconds is not None:
+            max_seconds *= scale
+        return cls(max_states*scale, max_seconds)
+
+    @property
+    def elapsed(self):
+        return time.time() - self.start_time
+
+    def exhausted(self):
+        if self.states > self.max_states:
+            return True
+        return self.max_seconds is not None and self.elapsed > self.max_seconds
+
+    @property
+    def performance(self):
+        dt = self.elapsed
+        return "%4.0fk states / %3.0f s = %4.0fk states/s (%4.0fk repeats, %4.0fk dominated)" % (
+            self.states/1000,
+            dt,
+            self.states/1000/dt,
+            self.repeats/1000,
+            self.dominated/1000,
+        )
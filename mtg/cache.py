@@ -0,0 +1,102 @@
+"""
+The outcome of a trial only depends on whether we're on the play, which
+cards are in the opening hand, and the order of however many cards after
+that the search actually looks at. Most hands only ever see a handful of
+those. Over enough trials of the same list, the same position comes up
+again and again, and there's no need to search it twice.
+
+Solved positions go in a SQLite database, keyed on the deck list (as a
+multiset, since tutors care what's in the deck), the opening hand (also as
+a multiset), and the cards revealed after it, in order. Overflows depend
+on the budget, so they don't get stored.
+
+Card behavior lives in carddata.yaml as much as in the code, so the key
+also includes a digest of that file. Editing a card's effects starts a
+fresh set of positions rather than serving up outcomes that no longer
+hold.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+
+# Bump this whenever a change to the engine could change outcomes.
+VERSION = 2
+with open("carddata.yaml", "rb") as handle:
+    CARD_DATA_DIGEST = hashlib.sha1(handle.read()).hexdigest()
+PATH = os.path.join("cache", "positions.sqlite")
+HAND_SIZE = 7
+
+CONNECTION = None
+CONNECTION_PID = None
+
+
+def connect():
+    """SQLite connections don't survive a fork. Each process opens its own."""
+    global CONNECTION, CONNECTION_PID
+    if CONNECTION_PID != os.getpid():
+        os.makedirs(os.path.dirname(PATH), exist_ok=True)
+        CONNECTION = sqlite3.connect(PATH, timeout=60)
+        CONNECTION.execute("PRAGMA journal_mode=WAL")
+        CONNECTION.execute(
+            "CREATE TABLE IF NOT EXISTS positions ("
+            " deck TEXT, on_the_play INTEGER, max_turns INTEGER,"
+            " hand TEXT, revealed TEXT, summary TEXT, report TEXT,"
+            " PRIMARY KEY (deck, on_the_play, max_turns, hand, revealed))"
+        )
+        CONNECTION_PID = os.getpid()
+    return CONNECTION
+
+
+def deck_key(deck_list, kwargs):
+    text = json.dumps([VERSION, CARD_DATA_DIGEST, sorted(deck_list), sorted(kwargs.items())])
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def hand_key(deck_list):
+    return "\n".join(sorted(deck_list[:HAND_SIZE]))
+
+
+def lookup(deck_list, kwargs, on_the_play, max_turns):
+    """Return the summary and report for a stored position that matches
+    this shuffle, or None.
+    """
+    prefixes = [
+        "\n".join(deck_list[HAND_SIZE:n])
+        for n in range(HAND_SIZE, len(deck_list) + 1)
+    ]
+    row = connect().execute(
+        "SELECT summary, report FROM positions"
+        " WHERE deck = ? AND on_the_play = ? AND max_turns = ? AND hand = ?"
+        f" AND revealed IN ({', '.join('?'*len(prefixes))}) LIMIT 1",
+        (
+            deck_key(deck_list, kwargs),
+            on_the_play,
+            max_turns,
+            hand_key(deck_list),
+            *prefixes,
+        ),
+    ).fetchone()
+    if row is None:
+        return None
+    summary, report = row
+    return json.loads(summary), report
+
+
+def store(deck_list, kwargs, on_the_play, max_turns, deepest, summary, report):
+    revealed = "\n".join(deck_list[HAND_SIZE:max(deepest, HAND_SIZE)])
+    with connect() as connection:
+        connection.execute(
+            "INSERT OR IGNORE INTO positions VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                deck_key(deck_list, kwargs),
+                on_the_play,
+                max_turns,
+                hand_key(deck_list),
+                revealed,
+                json.dumps(summary),
+                report,
+            ),
+        )
+    return
@@ -1,21 +1,60 @@
 import collections
+import operator
 import sys
 import yaml
 
-from .mana import Mana
-from . import helpers
+from .mana import Mana, pareto_front
+from . import helpers, mana
 
 
 with open("carddata.yaml") as handle:
     CARDS = yaml.safe_load(handle)
 
 
+# Each card gets a fixed index based on its position in carddata.yaml. Cards
+# that aren't in the file get tacked on at the end as we run into them.
+CARD_INDEX = {name: i for i, name in enumerate(CARDS)}
+
+
+class CardKeys(dict):
+    """A fixed, random-looking key for each card index (by way of
+    splitmix64). The same card always gets the same key, from one run to
+    the next.
+    """
+
+    def __missing__(self, index):
+        z = (index + 0x9E3779B97F4A7C15) & MASK64
+        z = ((z ^ (z >> 30))*0xBF58476D1CE4E5B9) & MASK64
+        z = ((z ^ (z >> 27))*0x94D049BB133111EB) & MASK64
+        self[index] = (z ^ (z >> 31)) % HASH_MODULUS
+        return self[index]
+
+
+MASK64 = (1 << 64) - 1
+# Stay below the modulus Python uses for hashing ints, so that hash() hands
+# back exactly what __hash__ returns.
+HASH_MODULUS = (1 << 61) - 1
+CARD_KEYS = CardKeys()
+
+
 class Cards(tuple):
+    """A multiset of cards, like a hand or a battlefield. Cards are kept
+    sorted by index so that the same cards in a different order compare
+    (and hash) equal. Otherwise, GameStates can't collapse two states
+    that differ only by the order we played things in.
+    """
 
     def __new__(self, names):
-        cards = [Card(x) for x in names]
+        cards = sorted((Card(x) for x in names), key=Card.sort_key)
         return tuple.__new__(self, cards)
 
+    @classmethod
+    def _sorted(cls, cards):
+        """Skip the conversion. Only for cards we already know are Card
+        objects.
+        """
+        return tuple.__new__(cls, sorted(cards, key=Card.sort_key))
+
     def __str__(self):
         blurbs = []
         for card in sorted(set(self)):
@@ -26,19 +65,30 @@ class Cards(tuple):
                 blurbs.append(str(card))
         return " ".join(blurbs)
 
+    def __hash__(self):
+        h = getattr(self, "_hash", None)
+        if h is None:
+            h = self._hash = sum(CARD_KEYS[x.index] for x in self) % HASH_MODULUS
+        return h
+
     def __add__(self, other):
-        if isinstance(other, str):
-            other = Card(other)
-        if isinstance(other, Card):
-            other = [other]
-        return Cards(list(self) + list(other))
+        if isinstance(other, (str, Card)):
+            other = (other,)
+        other = tuple(Card(x) for x in other)
+        cards = Cards._sorted(tuple(self) + other)
+        cards._hash = (hash(self) + sum(CARD_KEYS[x.index] for x in other)) % HASH_MODULUS
+        return cards
 
     def __sub__(self, other):
         if isinstance(other, (str, Card)):
             other = (other,)
+        other = tuple(Card(x) for x in other)
         new_seq = list(self)
-        [new_seq.remove(Card(x)) for x in other]
-        return Cards(new_seq)
+        [new_seq.remove(x) for x in other]
+        # Removing items doesn't mess up the order.
+        cards = tuple.__new__(Cards, new_seq)
+        cards._hash = (hash(self) - sum(CARD_KEYS[x.index] for x in other)) % HASH_MODULUS
+        return cards
 
     def __and__(self, other):
         return Cards(set(self) & set(other))
@@ -52,43 +102,58 @@ class Cards(tuple):
     def count(self, card):
         return tuple.count(self, Card(card))
 
+    def issuperset(self, other):
+        """Multiset containment: every card in other, with multiplicity.
+        Both sides are sorted, so we can walk them together.
+        """
+        if len(other) > len(self):
+            return False
+        mine = iter(self)
+        for card in other:
+            for x in mine:
+                if x == card:
+                    break
+            else:
+                return False
+        return True
+
     def bounces(self, best=True):
-        cards = {x for x in self if "bounce" in x.types}
+        cards = {x for x in self if x.data.type_flags & BOUNCE}
         return best_cards(cards) if best else Cards(cards)
 
     def artifacts(self, best=True):
-        cards = {x for x in self if "artifact" in x.types}
+        cards = {x for x in self if x.data.type_flags & ARTIFACT}
         return best_cards(cards) if best else Cards(cards)
 
     def basic_lands(self, best=True):
-        cards = {x for x in self if "basic" in x.types and "land" in x.types}
+        cards = {x for x in self if x.data.type_flags & BASIC and x.data.type_flags & LAND}
         return best_cards(cards) if best else Cards(cards)
 
     def colorless(self, best=True):
-        cards = {x for x in self if not x.colors}
+        cards = {x for x in self if not x.data.color_flags}
         return best_cards(cards) if best else Cards(cards)
 
     def creatures(self, best=True):
-        cards = {x for x in self if "creature" in x.types}
+        cards = {x for x in self if x.data.type_flags & CREATURE}
         return best_cards(cards) if best else Cards(cards)
 
     def creatures_lands(self, best=True):
         return self.creatures(best=best) + self.lands(best=best)
 
     def enchantments(self, best=True):
-        cards = {x for x in self if "enchantment" in x.types}
+        cards = {x for x in self if x.data.type_flags & ENCHANTMENT}
         return best_cards(cards) if best else Cards(cards)
 
     def forests(self, best=True):
-        cards = {x for x in self if "forest" in x.types}
+        cards = {x for x in self if x.data.type_flags & FOREST}
         return best_cards(cards) if best else Cards(cards)
 
     def lands(self, best=True):
-        cards = {x for x in self if "land" in x.types}
+        cards = {x for x in self if x.data.type_flags & LAND}
         return best_cards(cards) if best else Cards(cards)
 
     def greens(self, best=True):
-        cards = {x for x in self if "green" in x.colors}
+        cards = {x for x in self if x.data.color_flags & GREEN}
         return best_cards(cards) if best else Cards(cards)
 
     def green_creatures(self, best=True):
@@ -98,14 +163,23 @@ class Cards(tuple):
         return self.creatures(**kwargs) | self.lands(**kwargs) | self.artifacts(**kwargs) | self.enchantments(**kwargs)
 
     def trinkets(self, best=True):
-        cards = {x for x in self if "artifact" in x.types and x.cmc < 2}
+        cards = {x for x in self if x.data.type_flags & ARTIFACT and x.data.cmc < 2}
         return best_cards(cards) if best else Cards(cards)
 
     def zeros(self, best=True):
-        cards = {x for x in self if x.cmc == 0}
+        cards = {x for x in self if x.data.cmc == 0}
         return best_cards(cards) if best else Cards(cards)
 
 
+class Deck(Cards):
+    """An ordered pile of cards, like a library. Unlike Cards, the order
+    matters here, so we don't sort.
+    """
+
+    def __new__(self, names):
+        return tuple.__new__(self, [Card(x) for x in names])
+
+
 def best_cards(cards):
     """If Ancient Stirrings shows Gemstone Mine and Radiant
     Fountain, there's no reason for the model to ever take Radiant
@@ -159,7 +233,7 @@ def best_cards(cards):
 # ----------------------------------------------------------------------
 
 
-CardBase = collections.namedtuple("CardBase", "name show slug dies")
+CardBase = collections.namedtuple("CardBase", "name show slug dies index")
 
 
 class Card(CardBase):
@@ -181,9 +255,15 @@ class Card(CardBase):
 
             show = helpers.rmchars(name.replace("'", "").title(), "- ,.")
             slug = helpers.slug(name)
-            cls._instances[name] = CardBase.__new__(cls, name, show, slug, dies)
+            index = CARD_INDEX.setdefault(name, len(CARD_INDEX))
+            cls._instances[name] = CardBase.__new__(cls, name, show, slug, dies, index)
         return cls._instances[name]
 
+    sort_key = operator.attrgetter("index", "dies")
+
+    def __reduce__(self):
+        return (Card, (self.name + "*" if self.dies else self.name,))
+
     def __repr__(self):
         return "Card(" + repr(self.name) + ")"
 
@@ -200,7 +280,9 @@ class Card(CardBase):
             return self.show
 
     def __hash__(self):
-        return tuple.__hash__(self)
+        # Cards compare by name, so hash by name too. The index stands in
+        # for the name and is much cheaper to hash than the whole tuple.
+        return self.index
 
     def __eq__(self, other):
         if isinstance(other, str):
@@ -208,59 +290,168 @@ class Card(CardBase):
         else:
             return other.name == self.name
 
+    @property
+    def data(self):
+        return CARD_DATA[self.index]
+
     @property
     def colors(self):
-        raw_colors = CARDS[self.name].get("color")
-        return raw_colors.split(",") if raw_colors else ()
+        return self.data.colors
 
     @property
     def types(self):
-        return CARDS[self.name]["type"].split(",")
+        return self.data.types
 
     @property
     def cost(self):
-        cost = CARDS[self.name].get("cost")
-        return None if cost is None else Mana(cost)
+        return self.data.cost
 
     @property
-    def cmc(self):
-        cost = CARDS[self.name].get("cost")
-        return 0 if cost is None else Mana(cost).total
+    def cast_touches(self):
+        return self.data.cast_touches
 
     @property
-    def types(self):
-        return CARDS[self.name]["type"].split(",")
+    def cmc(self):
+        return self.data.cmc
 
     @property
     def can_be_titan(self):
-        return CARDS[self.name].get("can_be_titan")
+        return self.data.can_be_titan
 
     @property
     def cycle_cost(self):
-        cost = CARDS[self.name].get("cycle_cost")
-        return None if cost is None else Mana(cost)
+        return self.data.cycle_cost
 
     @property
     def cycle_verb(self):
-        return CARDS[self.name].get("cycle_verb", "discard")
+        return self.data.cycle_verb
 
     @property
     def enters_tapped(self):
-        return CARDS[self.name].get("enters_tapped")
+        return self.data.enters_tapped
+
+    @property
+    def pact_cost(self):
+        return self.data.pact_cost
 
     @property
     def sacrifice_cost(self):
-        cost = CARDS[self.name].get("sacrifice_cost")
-        return None if cost is None else Mana(cost)
+        return self.data.sacrifice_cost
 
     @property
     def taps_for(self):
-        taps_for = CARDS[self.name].get("taps_for")
-        if taps_for is None:
-            return None
-        else:
-            mana_options = {Mana(x) for x in taps_for.split(",")}
-            # If it taps for G or U, but we're ignoring U, U will get
-            # downgraded to 1. Don't even return that.
-            mana_options_pruned = mana_options - {Mana("1")}
-            return mana_options_pruned or mana_options
+        return self.data.taps_for
+
+
+# ----------------------------------------------------------------------
+
+
+CardData = collections.namedtuple(
+    "CardData",
+    [
+        "can_be_titan",
+        "cast_touches",
+        "cmc",
+        "color_flags",
+        "colors",
+        "cost",
+        "cycle_cost",
+        "cycle_verb",
+        "enters_tapped",
+        "pact_cost",
+        "sacrifice_cost",
+        "taps_for",
+        "type_flags",
+        "types",
+    ]
+)
+
+
+# Types and colors as bit flags, so the filters in Cards don't have to do
+# any string comparisons.
+TYPE_FLAGS = {}
+COLOR_FLAGS = {}
+for _data in CARDS.values():
+    for _type in filter(None, (_data.get("type") or "").split(",")):
+        TYPE_FLAGS.setdefault(_type, 1 << len(TYPE_FLAGS))
+    for _color in filter(None, (_data.get("color") or "").split(",")):
+        COLOR_FLAGS.setdefault(_color, 1 << len(COLOR_FLAGS))
+ARTIFACT = TYPE_FLAGS["artifact"]
+BASIC = TYPE_FLAGS["basic"]
+BOUNCE = TYPE_FLAGS["bounce"]
+CREATURE = TYPE_FLAGS["creature"]
+ENCHANTMENT = TYPE_FLAGS["enchantment"]
+FOREST = TYPE_FLAGS["forest"]
+LAND = TYPE_FLAGS["land"]
+GREEN = COLOR_FLAGS["green"]
+
+
+# Card data indexed by Card.index. Parsed mana depends on which colors we
+# are tracking, so this gets rebuilt whenever that changes.
+CARD_DATA = []
+CARD_DATA_COLORS = None
+
+
+def compile_card_data():
+    """Parse everything in carddata.yaml once, up front, rather than every
+    time we look at a card. Mana costs depend on which colors we're
+    tracking, so call this again after mana.set_colors.
+    """
+    global CARD_DATA_COLORS
+    ignore_colors = frozenset(mana.IGNORE_COLORS)
+    if CARD_DATA and ignore_colors == CARD_DATA_COLORS:
+        return
+    CARD_DATA[:] = [card_data(CARDS[name]) for name in CARDS]
+    CARD_DATA_COLORS = ignore_colors
+
+
+def card_data(raw):
+    colors = tuple(raw["color"].split(",")) if raw.get("color") else ()
+    types = tuple(raw["type"].split(","))
+    cost = parse_mana(raw.get("cost"))
+    # What casting this card changes, besides paying for it. Cards that
+    # don't say could do anything.
+    cast_touches = raw.get("cast_touches")
+    if cast_touches is not None:
+        cast_touches = frozenset(cast_touches.split(","))
+    taps_for = raw.get("taps_for")
+    if taps_for is not None:
+        # If it taps for G or U, but we're ignoring U, U will get
+        # downgraded to 1. Don't even return that.
+        taps_for = frozenset(pareto_front(Mana(x) for x in taps_for.split(",")))
+    return CardData(
+        can_be_titan=raw.get("can_be_titan"),
+        cast_touches=cast_touches,
+        cmc=0 if cost is None else cost.total,
+        color_flags=sum(COLOR_FLAGS[x] for x in colors),
+        colors=colors,
+        cost=cost,
+        cycle_cost=parse_mana(raw.get("cycle_cost")),
+        cycle_verb=raw.get("cycle_verb", "discard"),
+        enters_tapped=raw.get("enters_tapped"),
+        pact_cost=parse_mana(raw.get("pact_cost")),
+        sacrifice_cost=parse_mana(raw.get("sacrifice_cost")),
+        taps_for=taps_for,
+        type_flags=sum(TYPE_FLAGS.get(x, 0) for x in types),
+        types=types,
+    )
+
+
+def colors_needed(cards):
+    """Which colors of mana could these cards ever ask for? If nothing
+    needs blue, there's no difference between blue mana and colorless, and
+    keeping track of it just multiplies the number of states.
+    """
+    colors = set()
+    for card in set(cards):
+        raw = CARDS.get(card.name, {})
+        for key in ("cost", "cycle_cost", "pact_cost", "sacrifice_cost"):
+            colors |= set(str(raw.get(key) or "")) & set(mana.COLORS)
+    return "".join(x for x in mana.COLORS if x in colors)
+
+
+def parse_mana(expr):
+    return None if expr is None else Mana(expr)
+
+
+compile_card_data()
@@ -0,0 +1,116 @@
+"""
+Running trials in parallel doesn't help when one hand takes a minute by
+itself. Instead, we can split a single hand's search across processes,
+one turn at a time. Each turn, the frontier (the states waiting to be
+expanded) gets cut into chunks. Workers take chunks as they free up, so a
+worker that gets an easy chunk goes back for another rather than sitting
+idle, and each one runs its chunk through to the end of the turn. The
+results get merged back together. GameStates is a set, so positions found
+by more than one worker collapse on their own.
+
+As soon as any worker finds a solution, or the search runs out of
+budget, the rest get shut down. Workers only check the budget against
+their own states, so a search can go a bit over while the last few chunks
+are finishing up.
+"""
+
+import multiprocessing as mp
+
+from . import stats
+from .state import GameStates, TooManyStates
+
+# Cut the frontier into more chunks than there are workers, so that there's
+# always something left for whoever finishes first.
+CHUNKS_PER_WORKER = 2
+# The chunks for the current turn. Workers are forked after this gets
+# filled in, so they already have a copy, and we only need to send them an
+# index. That's a lot cheaper than pickling the states. It also means the
+# pool never has a big task stuck in the pipe when we shut it down early.
+CHUNKS = []
+
+
+def next_turn(states, max_turns, workers):
+    """Same as GameStates.next_turn, but spread across processes."""
+    if not states:
+        return GameStates()
+    budget = next(iter(states)).budget
+    pending, finished = spread(states, max_turns, workers*CHUNKS_PER_WORKER)
+    # If the whole turn fit in here, there's nothing to hand out.
+    if not pending:
+        return finished.prune_dominated()
+    # Similar states are more likely to run into the same positions, so try
+    # to keep them in the same chunk.
+    pending = sorted(pending, key=lambda x: (x.battlefield, x.hand))
+    nchunks = min(len(pending), workers*CHUNKS_PER_WORKER)
+    size = -(-len(pending)//nchunks)
+    CHUNKS[:] = [(pending[i:i+size], max_turns) for i in range(0, len(pending), size)]
+    # Workers count on inheriting the chunks, along with the rest of the
+    # parent's setup (which colors we're tracking, the compiled card data),
+    # so they have to be forked.
+    try:
+        with mp.get_context("fork").Pool(workers) as pool:
+            for states, counters, counts in pool.imap_unordered(expand, range(len(CHUNKS))):
+                budget.states += counters[0]
+                budget.repeats += counters[1]
+                budget.dominated += counters[2]
+                budget.deepest = max(budget.deepest, counters[3])
+                stats.COUNTS.update(counts)
+                # Each worker only knows about its own states, so keep an eye
+                # on the total here.
+                if states is None or budget.exhausted():
+                    raise TooManyStates
+                # The worker had its own copy of the budget.
+                states = [x.rebind(budget) for x in states]
+                # Leaving the block terminates the pool, which stops
+                # everyone else.
+                for state in states:
+                    if state.done or state.overflowed:
+                        return GameStates([state])
+                finished.update(states)
+    finally:
+        CHUNKS.clear()
+    return finished.prune_dominated()
+
+
+def spread(states, max_turns, n):
+    """A turn often starts from just a handful of states. Expand them
+    breadth-first until we have at least n states to hand out (or until
+    the turn is over). Return the states that are still in this turn, and
+    the ones that have moved on to the next. If we run into a solution,
+    that's the only thing we return.
+    """
+    turn = next(iter(states)).turn
+    pending, finished = GameStates(states), GameStates()
+    seen = set()
+    while pending and len(pending) < n:
+        state = pending.pop()
+        seen.add(state)
+        for child in state.next_states(max_turns):
+            if child.done or child.overflowed:
+                return GameStates(), GameStates([child])
+            elif child.turn > turn:
+                finished.add(child)
+            elif child not in seen:
+                pending.add(child)
+    return pending, finished
+
+
+def expand(i):
+    """Run one chunk of the frontier through to the end of the turn. Send
+    back the resulting states (or None if we ran out of budget), along
+    with the budget's counters and any instrumentation counts.
+    """
+    chunk, max_turns = CHUNKS[i]
+    budget = chunk[0].budget
+    before = (budget.states, budget.repeats, budget.dominated)
+    try:
+        states = list(GameStates(chunk).next_turn(max_turns=max_turns))
+    except TooManyStates:
+        states = None
+    counters = (
+        budget.states - before[0],
+        budget.repeats - before[1],
+        budget.dominated - before[2],
+        budget.deepest,
+    )
+    return states, counters, stats.take()
@@ -1,3 +1,6 @@
+import collections
+
+
 def rmchars(text, chars):
     for c in chars:
         text = text.replace(c, "")
@@ -7,6 +10,32 @@ def slug(text):
     return rmchars(text, "',").lower().replace(" ", "_").replace("-", "_")
 
 
+def splits(limits, n):
+    """Every way to take n things from piles of the given sizes, as a
+    tuple saying how many come from each pile.
+    """
+    if not limits:
+        if n == 0:
+            yield ()
+        return
+    rest = sum(limits[1:])
+    for k in range(max(0, n - rest), min(limits[0], n) + 1):
+        for tail in splits(limits[1:], n - k):
+            yield (k,) + tail
+
+
+def multiset_combinations(items, n):
+    """Like itertools.combinations, but copies of the same item are
+    interchangeable. With four Forests, there's only one way to pick two of
+    them, not six.
+    """
+    counts = collections.Counter(items)
+    for taken in splits(list(counts.values()), n):
+        yield tuple(
+            x for x, k in zip(counts, taken) for _ in range(k)
+        )
+
+
 def highlight(text, color=None):
     if color == "green":
         return "\033[32m" + text + "\033[0m"
@@ -1,10 +1,12 @@
 """
 We keep track of green, blue, and total/other. This means we potentially
 have to look at multiple ways to pay each cost.
-"""
 
-import collections
-import itertools
+A mana pool is packed into a single integer: one byte per color plus one
+byte for the total. Adding pools is just integer addition, and comparing
+them takes a couple of bit operations. The top bit of each byte stays
+clear, which caps us at 127 of anything -- way more than we'll ever see.
+"""
 
 from . import helpers
 
@@ -19,26 +21,45 @@ def set_colors(colors):
     """
     global IGNORE_COLORS
     IGNORE_COLORS = {"W", "U", "B", "R", "G"} - set(str(colors).upper())
+    # Parsed strings depend on which colors we're ignoring.
+    PARSE_CACHE.clear()
     return
 
 
-ManaBase = collections.namedtuple("Mana", "wubrg total")
+BITS = 8
+COLORS = "WUBRG"
+# Total lives in the byte above the five colors.
+TOTAL_SHIFT = BITS*len(COLORS)
+FIELD = (1 << BITS) - 1
+# The top bit of each byte. Used to compare all fields at once.
+GUARD = sum(1 << (BITS*i + BITS - 1) for i in range(len(COLORS) + 1))
+COLORED = (1 << TOTAL_SHIFT) - 1
+
+# Parsing a string is slow, and we only ever see a handful of them.
+PARSE_CACHE = {}
+# Map (pool, cost) to the set of pools that could be left over.
+MINUS_CACHE = {}
 
-class Mana(ManaBase):
+
+class Mana(int):
 
     def __new__(cls, expr=""):
+        if isinstance(expr, int):
+            return int.__new__(cls, expr)
         if isinstance(expr, tuple):
-            return ManaBase.__new__(cls, *expr)
-        # For colors we ignore, swap out that mana symbol for a "1"
-        for ic in IGNORE_COLORS:
-            expr = expr.replace(ic, "1")
-        wubrg = tuple(expr.count(m) for m in "WUBRG")
-        # Total comes from colored mana as well as generic (or ignored). Sum
-        # each digit individually. Multi-digit numbers are not allowed.
-        total = sum(wubrg) + sum(int(c) for c in expr if c.isdigit())
-        # Optimization: do we really need to track more than 3 mana per color?
-#        wubrg = tuple(min(x, 3) for x in wubrg)
-        return ManaBase.__new__(cls, wubrg, total)
+            wubrg, total = expr
+            return int.__new__(cls, pack(wubrg, total))
+        if expr not in PARSE_CACHE:
+            PARSE_CACHE[expr] = int.__new__(cls, parse(expr))
+        return PARSE_CACHE[expr]
+
+    @property
+    def wubrg(self):
+        return tuple((self >> BITS*i) & FIELD for i in range(len(COLORS)))
+
+    @property
+    def total(self):
+        return self >> TOTAL_SHIFT
 
     @property
     def colored(self):
@@ -51,17 +72,13 @@ class Mana(ManaBase):
     def __add__(self, other):
         if isinstance(other, str):
             other = Mana(other)
-        wubrg = tuple(s+o for s, o in zip(self.wubrg, other.wubrg))
-        # Optimization: do we really need to track more than 3 mana per color?
-#        wubrg = tuple(min(x, 3) for x in wubrg)
-        total = self.total + other.total
-        return Mana((wubrg, total))
+        return int.__new__(Mana, int(self) + int(other))
 
     def name(self):
         expr = ""
         if self.colorless or not self.colored:
             expr = str(self.colorless)
-        for n, m in zip(self.wubrg, "WUBRG"):
+        for n, m in zip(self.wubrg, COLORS):
             expr += n*m
         return expr
 
@@ -72,13 +89,15 @@ class Mana(ManaBase):
         return "Mana(" + repr(self.name()) + ")"
 
     def __bool__(self):
-        return self.total > 0
+        return self > COLORED
 
     def __ge__(self, other):
-        return all(s >= o for s, o in zip(self.wubrg, other.wubrg)) and self.total >= other.total
+        # Subtract every field at once. A field that goes negative borrows
+        # from its guard bit.
+        return (int(self) | GUARD) - int(other) & GUARD == GUARD
 
     def __le__(self, other):
-        return all(s <= o for s, o in zip(self.wubrg, other.wubrg)) and self.total <= other.total
+        return Mana.__ge__(other, self)
 
     def __sub__(self, other):
         """Only works for paying exactly. Does not allow you to pay a
@@ -86,11 +105,9 @@ class Mana(ManaBase):
         """
         if isinstance(other, str):
             other = Mana(other)
-        wubrg = tuple(s-o for s, o in zip(self.wubrg, other.wubrg))
-        total = self.total - other.total
-        if any(x<0 for x in wubrg) or self.colorless < other.colorless:
+        if not self >= other or self.colorless < other.colorless:
             raise ValueError(f"ambiguous subtraction {self} - {other}")
-        return Mana((wubrg, total))
+        return int.__new__(Mana, int(self) - int(other))
 
     def minus(self, cost):
         """Accept a mana cost. Return a list of potential pools
@@ -98,6 +115,12 @@ class Mana(ManaBase):
         """
         if isinstance(cost, str):
             cost = Mana(cost)
+        key = (self, cost)
+        if key not in MINUS_CACHE:
+            MINUS_CACHE[key] = frozenset(pareto_front(self._minus(cost)))
+        return MINUS_CACHE[key]
+
+    def _minus(self, cost):
         if not cost <= self:
             return set()
         # If we can subtract unambiguously, do so. If we make it past
@@ -109,13 +132,43 @@ class Mana(ManaBase):
         except ValueError:
             pass
         # How much generic cost do we need to pay with colored mana?
-        to_pay = max(cost.colorless - self.colorless, 0)
+        to_pay = cost.colorless - self.colorless
         # What colored mana do we have sitting around?
-        wubrg = [s-c for s, c in zip(self.wubrg, cost.wubrg)]
-        spare_mana_str = "".join(n*m for n, m in zip(wubrg, "WUBRG"))
-        spare_mana = Mana(spare_mana_str)
+        spare = [s-c for s, c in zip(self.wubrg, cost.wubrg)]
+        total = self.total - cost.total
+        # Each way of splitting the generic cost across the colors we have
+        # gives a distinct leftover pool.
         manas = set()
-        for m in itertools.combinations(spare_mana_str, to_pay):
-            leftover = spare_mana - Mana("".join(m))
-            manas.add(leftover)
+        for paid in helpers.splits(spare, to_pay):
+            wubrg = [n-p for n, p in zip(spare, paid)]
+            manas.add(Mana((wubrg, total)))
         return manas
+
+
+def pareto_front(pools):
+    """If one pool has at least as much of each color as another (and at
+    least as much in total), there's never a reason to pick the other.
+    Throw those out.
+    """
+    pools = set(pools)
+    if len(pools) < 2:
+        return pools
+    return {x for x in pools if not any(y >= x and y != x for y in pools)}
+
+
+def pack(wubrg, total):
+    value = total << TOTAL_SHIFT
+    for i, n in enumerate(wubrg):
+        value |= n << BITS*i
+    return value
+
+
+def parse(expr):
+    # For colors we ignore, swap out that mana symbol for a "1"
+    for ic in IGNORE_COLORS:
+        expr = expr.replace(ic, "1")
+    wubrg = tuple(expr.count(m) for m in COLORS)
+    # Total comes from colored mana as well as generic (or ignored). Sum
+    # each digit individually. Multi-digit numbers are not allowed.
+    total = sum(wubrg) + sum(int(c) for c in expr if c.isdigit())
+    return pack(wubrg, total)
@@ -1,31 +1,102 @@
 import os
 import random
-import time
-import yaml
 
-from . import state, output, helpers
+from . import cache, frontier, state, output, helpers
+from .budget import Budget, MAX_STATES
 
 
-def simulate(name, trial=0, max_turns=3):
+def simulate(
+    name,
+    trial=0,
+    max_turns=3,
+    search="bfs",
+    use_cache=True,
+    seed=None,
+    max_states=MAX_STATES,
+    max_seconds=None,
+    tier=0,
+    retries=0,
+    workers=1,
+):
+    """Shuffle up and play. If given a seed, the shuffle only depends on
+    that, so a hand that overflows can be tried again later with a bigger
+    budget (a higher tier). Results only get saved once they're final.
+    """
+    rng = random if seed is None else random.Random(seed)
+    on_the_play = bool(rng.randrange(2))
+    deck_list, kwargs = load_deck(name, rng)
+    summary, report, performance = play(
+        deck_list,
+        kwargs,
+        on_the_play,
+        max_turns,
+        search,
+        use_cache,
+        Budget.for_tier(tier, max_states, max_seconds),
+        workers,
+    )
+    tally = str(trial).ljust(5)
+    if overflowed(summary) and tier < retries:
+        performance += ", will retry with a bigger budget"
+    else:
+        output.save(name, summary)
+    print(tally, name.ljust(12), summarize(summary), performance)
+    return summary, report
+
+
+def overflowed(summary):
+    return None in summary["turns"].values()
+
+
+def play(
+    deck_list,
+    kwargs,
+    on_the_play,
+    max_turns=3,
+    search="bfs",
+    use_cache=True,
+    budget=None,
+    workers=1,
+):
+    """Play out one shuffled deck. Return the turn-by-turn summary, the
+    winning line (or None), and a note about how long it took. With more
+    than one worker, breadth-first search splits each turn across that many
+    processes.
+    """
+    # If we've already solved this position, don't bother searching.
+    if use_cache:
+        hit = cache.lookup(deck_list, kwargs, on_the_play, max_turns)
+        if hit is not None:
+            summary, report = hit
+            return summary, report, "   cached"
+    if budget is None:
+        budget = Budget()
     # Keep track of the initial game state. If we fail to converge, this
     # is what we'll return so we know if we were on the play or draw.
-    starttime = time.time()
-    on_the_play = bool(random.randrange(2))
-    deck_list, kwargs = load_deck(name)
     gs0 = state.GameState(
+        budget=budget,
         deck_list=deck_list,
         on_the_play=on_the_play,
-        reset_clock=True,
+        new_search=True,
         **kwargs,
     ).draw(7)
     # Keep track of data turn-by-turn. If we hit an overflow while computing
     # turn 4, we at least know there are no solutions for turn 3.
     summary = {"on_the_play": on_the_play, "turns": {}}
     # Keep track of the initial game state in case we hit an overflow
-    gs = gs0.pass_turn()
+    gs = gs1 = gs0.pass_turn()
     try:
         for turn in range(1, max_turns+1):
-            gs = gs.next_turn(max_turns=max_turns+1)
+            if search == "dfs":
+                # Iterative deepening. Each turn starts again from the top, but
+                # we only need to find one line, not the whole frontier. Once
+                # we have a solution, it holds for later turns too.
+                if not gs.done:
+                    gs = gs1.first_solution(max_turns=turn) or gs1
+            elif workers > 1:
+                gs = frontier.next_turn(gs, max_turns+1, workers)
+            else:
+                gs = gs.next_turn(max_turns=max_turns+1)
             # Internally, we keep track of whether or not this titan can have
             # haste. But if we want to store that data, we'll need to come back
             # and re-finagle the data structure.
@@ -37,18 +108,55 @@ def simulate(name, trial=0, max_turns=3):
         for t in range(turn, max_turns+1):
             summary["turns"][str(turn)] = None
         gs = gs0.overflow()
-    tally = str(trial).ljust(5)
     # If we found a solution or overflowed, we'll have just one state.
     # Multiple states means there's no solution.
-    dt = time.time() - starttime
     if len(gs) == 1 and gs.done:
-        output.save(name, summary)
-        print(tally, name.ljust(12), summarize(summary), gs.performance)
-        return gs.pop().report()
+        report = next(iter(gs)).report()
     else:
-        output.save(name, summary)
-        print(tally, name.ljust(12), summarize(summary), gs0.performance)
-        return None
+        report = None
+    # Overflows depend on the budget, so don't hang on to them.
+    if use_cache and not overflowed(summary):
+        cache.store(
+            deck_list,
+            kwargs,
+            on_the_play,
+            max_turns,
+            budget.deepest,
+            summary,
+            report,
+        )
+    return summary, report, budget.performance
+
+
+def play_with_retries(
+    deck_list,
+    kwargs,
+    on_the_play,
+    max_turns=3,
+    search="bfs",
+    use_cache=True,
+    max_states=MAX_STATES,
+    max_seconds=None,
+    retries=0,
+):
+    """Same as play, but if the hand overflows, try it again right away
+    with a bigger budget, up to the given number of retries. For runs that
+    need results in order, so they can't send the hand to the back of the
+    line.
+    """
+    for tier in range(retries+1):
+        summary, report, performance = play(
+            deck_list,
+            kwargs,
+            on_the_play,
+            max_turns,
+            search,
+            use_cache,
+            Budget.for_tier(tier, max_states, max_seconds),
+        )
+        if not overflowed(summary):
+            break
+    return summary, report, performance
 
 
 def summarize(summary):
@@ -61,7 +169,26 @@ def summarize(summary):
     return f"turn {turn} " + helpers.highlight("whiff", "brown") + f" {play_draw}"
 
 
-def load_deck(deckname):
+# Each worker reads each deck list once, then just shuffles a copy per trial.
+DECKS = {}
+
+
+def load_decks(decknames):
+    for deckname in decknames:
+        read_deck(deckname)
+    return
+
+
+def load_deck(deckname, rng=random):
+    cardnames, kwargs = read_deck(deckname)
+    cardnames = list(cardnames)
+    rng.shuffle(cardnames)
+    return cardnames, dict(kwargs)
+
+
+def read_deck(deckname):
+    if deckname in DECKS:
+        return DECKS[deckname]
     path = os.path.join("decks", f"{deckname}.in")
     kwargs = {}
     cardnames = []
@@ -78,5 +205,5 @@ def load_deck(deckname):
             cardnames += int(n) * [cardname]
     if len(cardnames) != 60:
         print("WARNING:", len(cardnames), "in", deckname)
-    random.shuffle(cardnames)
-    return cardnames, kwargs
+    DECKS[deckname] = (tuple(cardnames), kwargs)
+    return DECKS[deckname]
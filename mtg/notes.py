@@ -0,0 +1,52 @@
+"""
+Each GameState keeps a log of the actions that got it there. Most states
+get thrown away, so we don't want to pay to build (and copy) a big string
+for each one. Instead, the log is a linked list pointing back towards the
+start of the game. States that share a history share the same nodes, and
+adding a note is cheap no matter how long the log is. The text itself only
+gets put together when somebody asks for it.
+"""
+
+
+class Notes(object):
+    """An immutable node in the action log. Holds a format string and its
+    arguments, plus a pointer to the node before it.
+    """
+
+    __slots__ = ("parent", "text", "args", "lines")
+
+    def __init__(self, text="", *args, parent=None):
+        self.parent = parent
+        self.text = text
+        self.args = args
+        # Each line is an action. Keep a running count so that we can
+        # compare log lengths without rendering anything.
+        self.lines = text.count("\n") + (parent.lines if parent else 0)
+
+    def add(self, text, *args):
+        """Return a new log with this entry tacked on at the end. Any
+        arguments get formatted into the text when the log is rendered.
+        """
+        if not text:
+            return self
+        return Notes(text, *args, parent=self)
+
+    def __add__(self, text):
+        return self.add(text)
+
+    def __len__(self):
+        return self.lines
+
+    def __bool__(self):
+        return self.parent is not None or bool(self.text)
+
+    def __str__(self):
+        chunks = []
+        node = self
+        while node is not None:
+            chunks.append(node.text.format(*node.args) if node.args else node.text)
+            node = node.parent
+        return "".join(reversed(chunks))
+
+    def __repr__(self):
+        return "Notes(" + repr(str(self)) + ")"
@@ -1,48 +1,362 @@
+"""
+Each trial gets packed into two bytes: one bit for play/draw, then two bits
+per turn saying whether we got there (see CODES). Each process writes its
+own shard, output/<deck>.<pid>.bin, in batches, so parallel workers never
+touch the same file.
+
+Every shard starts with a header of running counters: how many trials, how
+many on the play, and how many titans and whiffs for each turn. These get
+updated every time the shard is flushed. Printing results only has to read
+the headers, no matter how many trials are behind them.
+
+Once a process is gone, its shard is finished. At the end of each run,
+finished shards get folded into a single output/<deck>.bin (see compact).
+
+Results from older versions were stored as JSON, one line per trial. Those
+can be converted with import_json.
+"""
+
 import collections
+import contextlib
+import fcntl
 import json
 import math
+import mmap
+import multiprocessing.util
 import os
+import struct
+import time
+
+
+# Outcome codes for each turn. A turn that never got looked at (because we
+# overflowed on an earlier turn) counts the same as an overflow.
+UNKNOWN, WHIFF, TITAN, OVERFLOW = range(4)
+CODES = {False: WHIFF, True: TITAN, None: OVERFLOW}
+
+MAX_TURNS = 7
+RECORD = struct.Struct("<H")
+
+MAGIC = b"MTG1"
+# Trials, trials on the play, then titans and whiffs for each turn.
+HEADER = struct.Struct("<4s" + "Q"*(2 + 2*MAX_TURNS))
+
+# Write out buffered results after this many records or this many seconds,
+# whichever comes first. Anything left over is written at exit.
+FLUSH_RECORDS = 100
+FLUSH_SECONDS = 10
+
+BUFFER = collections.defaultdict(list)
+LAST_FLUSH = time.time()
+# Pool workers skip atexit, but they do run multiprocessing finalizers.
+# Those are per-process, so note which process has registered one.
+FINALIZER_PID = None
+
+
+class Counts(collections.namedtuple("Counts", "trials on_the_play titans whiffs")):
+    """Running totals for a deck. Titans and whiffs are tuples indexed by
+    turn minus one.
+    """
+
+    def __new__(cls, trials=0, on_the_play=0, titans=None, whiffs=None):
+        titans = tuple(titans or (0,)*MAX_TURNS)
+        whiffs = tuple(whiffs or (0,)*MAX_TURNS)
+        return super().__new__(cls, trials, on_the_play, titans, whiffs)
+
+    def __add__(self, other):
+        return Counts(
+            self.trials + other.trials,
+            self.on_the_play + other.on_the_play,
+            [x + y for x, y in zip(self.titans, other.titans)],
+            [x + y for x, y in zip(self.whiffs, other.whiffs)],
+        )
+
+    def overflows(self, turn):
+        return self.trials - self.titans[turn-1] - self.whiffs[turn-1]
+
+    def add_record(self, record):
+        titans, whiffs = list(self.titans), list(self.whiffs)
+        for tmo in range(MAX_TURNS):
+            code = record >> (1 + 2*tmo) & 3
+            titans[tmo] += code == TITAN
+            whiffs[tmo] += code == WHIFF
+        return Counts(
+            self.trials + 1,
+            self.on_the_play + (record & 1),
+            titans,
+            whiffs,
+        )
+
+    def pack(self):
+        return HEADER.pack(
+            MAGIC, self.trials, self.on_the_play, *self.titans, *self.whiffs
+        )
+
+    @classmethod
+    def unpack(cls, data):
+        magic, trials, on_the_play, *rest = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError("not a results file")
+        return cls(trials, on_the_play, rest[:MAX_TURNS], rest[MAX_TURNS:])
+
+
+def encode(summary):
+    record = int(bool(summary["on_the_play"]))
+    for turn, outcome in summary["turns"].items():
+        turn = int(turn)
+        if not 1 <= turn <= MAX_TURNS:
+            raise ValueError(f"can't store results past turn {MAX_TURNS}")
+        record |= CODES[outcome] << (1 + 2*(turn-1))
+    return record
 
 
 def save(name, summary):
-    filename = os.path.join("output", f"{name}.json")
+    global FINALIZER_PID
+    if FINALIZER_PID != os.getpid():
+        multiprocessing.util.Finalize(None, flush, exitpriority=10)
+        FINALIZER_PID = os.getpid()
+    BUFFER[name].append(encode(summary))
+    n_records = sum(len(x) for x in BUFFER.values())
+    if n_records >= FLUSH_RECORDS or time.time() - LAST_FLUSH > FLUSH_SECONDS:
+        flush()
+
+
+def flush():
+    global LAST_FLUSH
+    LAST_FLUSH = time.time()
+    while BUFFER:
+        name, records = BUFFER.popitem()
+        write(shard_path(name), records)
+    return
+
+
+def write(filename, records):
+    """Append records to a shard, then bring its counters up to date. The
+    records go in before the header does, so a reader never sees counts for
+    records that aren't there yet.
+    """
     os.makedirs(os.path.dirname(filename), exist_ok=True)
-    with open(filename, "a") as handle:
-        handle.write(json.dumps(summary) + "\n")
+    if not os.path.exists(filename):
+        with open(filename, "wb") as handle:
+            handle.write(Counts().pack())
+    with open(filename, "r+b") as handle:
+        counts = Counts.unpack(handle.read(HEADER.size))
+        handle.seek(0, os.SEEK_END)
+        handle.write(b"".join(RECORD.pack(x) for x in records))
+        for record in records:
+            counts = counts.add_record(record)
+        handle.flush()
+        handle.seek(0)
+        handle.write(counts.pack())
+    return
+
+
+def shard_path(name):
+    return os.path.join("output", f"{name}.{os.getpid()}.bin")
+
+
+def shards(name, ext=".bin"):
+    """Deck names don't have dots in them. Anything between the name and
+    the extension identifies the shard.
+    """
+    if not os.path.isdir("output"):
+        return []
+    return sorted(
+        os.path.join("output", x) for x in os.listdir("output")
+        if x.split(".")[0] == name and x.endswith(ext)
+    )
+
+
+def counts(name):
+    """Add up the headers. Shards that a crashed compaction already folded
+    in (see compact) don't count twice.
+    """
+    with locked(name, fcntl.LOCK_SH):
+        merged = stale_shards(name)
+        total = Counts()
+        for filename in shards(name):
+            if filename not in merged:
+                total += header(filename)
+    return total
+
+
+def header(filename):
+    with open(filename, "rb") as handle:
+        return Counts.unpack(handle.read(HEADER.size))
+
+
+def read(filename):
+    """A shard's counts, and its records as raw bytes. A process killed
+    mid-write may leave records (or half of one) that the header doesn't
+    cover yet. Those get left out.
+    """
+    with open(filename, "rb") as handle:
+        with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            counts = Counts.unpack(data)
+            return counts, data[HEADER.size:HEADER.size + counts.trials*RECORD.size]
+
+
+@contextlib.contextmanager
+def locked(name, operation=fcntl.LOCK_EX):
+    """Compacting takes the deck's lock exclusively. Reading the counts
+    takes it shared, so it never catches a compaction halfway.
+    """
+    os.makedirs("output", exist_ok=True)
+    with open(os.path.join("output", f"{name}.lock"), "a") as handle:
+        fcntl.flock(handle, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+def merged_path(name):
+    return os.path.join("output", f"{name}.bin")
+
+
+def journal_path(name):
+    return os.path.join("output", f"{name}.journal")
+
+
+def stale_shards(name):
+    """If a compaction crashed after updating output/<name>.bin but before
+    deleting the shards it merged, return those shards.
+    """
+    if not os.path.exists(journal_path(name)):
+        return set()
+    with open(journal_path(name), "r") as handle:
+        journal = json.load(handle)
+    if header(merged_path(name)).trials != journal["trials"]:
+        return set()
+    return set(journal["shards"])
+
+
+def compact(name):
+    """Fold the shards of processes that have exited into output/<name>.bin,
+    so output/ doesn't grow by a file per worker per run. Only the new
+    records get copied, as raw bytes, and the headers get added up, so this
+    doesn't get slower as results pile up.
+
+    Like write, records go in before the header. Before either, a journal
+    notes which shards are being merged and what the trial count will be
+    once they are. If we crash partway, the next compaction (or reader)
+    can tell from the header whether the merge took.
+    """
+    with locked(name):
+        for filename in stale_shards(name):
+            os.remove(filename)
+        if os.path.exists(journal_path(name)):
+            os.remove(journal_path(name))
+        # Shards from processes that are still running get left alone. So
+        # do shards imported from JSON, since import_json looks for those.
+        finished = [x for x in shards(name) if finished_shard(x)]
+        if not finished:
+            return
+        target = merged_path(name)
+        if not os.path.exists(target):
+            with open(target, "wb") as handle:
+                handle.write(Counts().pack())
+        added = Counts()
+        chunks = []
+        for filename in finished:
+            counts, data = read(filename)
+            added += counts
+            chunks.append(data)
+        total = header(target) + added
+        with open(journal_path(name) + ".tmp", "w") as handle:
+            json.dump({"shards": finished, "trials": total.trials}, handle)
+        os.replace(journal_path(name) + ".tmp", journal_path(name))
+        with open(target, "r+b") as handle:
+            # Anything past what the header covers is left over from a
+            # compaction that didn't finish.
+            handle.seek(HEADER.size + (total.trials - added.trials)*RECORD.size)
+            handle.write(b"".join(chunks))
+            handle.truncate()
+            handle.flush()
+            os.fsync(handle.fileno())
+            handle.seek(0)
+            handle.write(total.pack())
+            handle.flush()
+            os.fsync(handle.fileno())
+        for filename in finished:
+            os.remove(filename)
+        os.remove(journal_path(name))
+    return
+
+
+def finished_shard(filename):
+    """Whether this is a per-process shard whose process has exited."""
+    middle = os.path.basename(filename).split(".")[1:-1]
+    if len(middle) != 1 or not middle[0].isdigit():
+        return False
+    try:
+        os.kill(int(middle[0]), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+def import_json(names):
+    """Convert results stored as JSON lines by older versions. Each JSON
+    file gets a matching binary shard; files that already have one are
+    skipped, so this is safe to run more than once.
+    """
+    for name in names:
+        for filename in shards(name, ext=".json"):
+            target = filename + ".bin"
+            if os.path.exists(target):
+                continue
+            records = []
+            with open(filename, "r") as handle:
+                for line in handle:
+                    try:
+                        records.append(encode(json.loads(line)))
+                    except json.JSONDecodeError:
+                        continue
+            # Write to a temporary file, then move it into place, so that a
+            # half-finished import doesn't look like a finished one.
+            write(target + ".tmp", records)
+            os.replace(target + ".tmp", target)
+            print("imported", len(records), "trials from", filename)
+    return
 
 
 def print_results(names):
     # If no names are given, grab them all
     if not names:
-        names = sorted(x.split(".")[0] for x in os.listdir("output"))
+        names = sorted({x.split(".")[0] for x in os.listdir("output")})
     namewidth = max(len(x) for x in names) + 1
     header = "name".ljust(namewidth)
     colwidth = 18
     for tmo in range(4):
         header += f"| turn {tmo+1} ".ljust(colwidth)
     print(header)
+    unimported = []
     for name in names:
-        filename = os.path.join("output", f"{name}.json")
-        if os.path.exists(filename):
-            with open(filename, "r") as handle:
-                docs = [json.loads(x) for x in handle]
-        else:
-            docs = []
+        if any(not os.path.exists(x + ".bin") for x in shards(name, ".json")):
+            unimported.append(name)
+        tally = counts(name)
         line = name.ljust(namewidth)
-        total = max(len(docs), 1)
+        total = max(tally.trials, 1)
         # Turns index from 1. Index arrays buy TMO (turn minus one)
         for tmo in range(4):
-            turn = str(tmo+1)
-            success = sum(1 for d in docs if d["turns"].get(turn) is True)
-            overflow = sum(1 for d in docs if d["turns"].get(turn) is None)
-            success_rate = pcts(success, total, z=2)
-            overflows = pct(overflow/total)
+            success_rate = pcts(tally.titans[tmo], total, z=2)
+            overflows = pct(tally.overflows(tmo+1)/total)
             line += f"| {success_rate} ({overflows}) "
         print(line)
+    if unimported:
+        print("Some results are still stored as JSON. To include them, run:")
+        print("./driver.py --import-json", " ".join(unimported))
     return
 
 
 def pcts(m, n, z=1):
+    p, dp = interval(m, n, z)
+    return pct(p) + " ± " + pct(dp)
+
+
+def interval(m, n, z=1):
     """Use a normal approximation to see what range of probabilities
     we're looking at based on the number of trials and the number of
     hits. One standard deviation by default.
@@ -60,7 +374,7 @@ def pcts(m, n, z=1):
 #    p = (pp+pm)/2
     p = m/n
     dp = (pp-pm)/2
-    return pct(p) + " ± " + pct(dp)
+    return p, dp
 
 
 def pct(x):
@@ -0,0 +1,101 @@
+"""
+Comparing two similar lists with independent shuffles takes a huge number
+of trials, since most of the difference between any two trials is luck of
+the draw. Instead, we can give every deck the same luck. For each trial,
+each card gets a random sort key based on its name, which copy it is, and
+the trial's seed. Shuffling is sorting by those keys. Cards that two lists
+have in common end up in the same relative order in both, so lists that
+differ by a few slots see mostly the same draws. Each deck's shuffle on its
+own is still uniformly random.
+
+Then we look at the difference between decks trial by trial, which is much
+less noisy than the difference between their overall rates.
+"""
+
+import collections
+import hashlib
+import math
+
+from . import manager, output
+
+
+def shuffle(cardnames, seed):
+    copies = collections.Counter()
+    keyed = []
+    for name in sorted(cardnames):
+        copies[name] += 1
+        keyed.append((sort_key(seed, f"{name}/{copies[name]}"), name))
+    return [name for _, name in sorted(keyed)]
+
+
+def sort_key(seed, text):
+    digest = hashlib.blake2b(f"{seed}/{text}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+def trial(task):
+    name, seed, max_turns, search, use_cache, max_states, max_seconds, retries = task
+    cardnames, kwargs = manager.read_deck(name)
+    deck_list = shuffle(cardnames, seed)
+    on_the_play = bool(sort_key(seed, "on the play") % 2)
+    summary, report, performance = manager.play_with_retries(
+        deck_list,
+        dict(kwargs),
+        on_the_play,
+        max_turns,
+        search,
+        use_cache,
+        max_states,
+        max_seconds,
+        retries,
+    )
+    output.save(name, summary)
+    print(str(seed).ljust(5), name.ljust(12), manager.summarize(summary), performance)
+    return summary
+
+
+def difference(summaries, baseline, turn):
+    """Mean difference in titan rate against the baseline, trial by trial,
+    and its standard error.
+    """
+    key = str(turn)
+    diffs = [
+        (x["turns"].get(key) is True) - (y["turns"].get(key) is True)
+        for x, y in zip(summaries, baseline)
+    ]
+    n = len(diffs)
+    mean = sum(diffs)/n
+    if n < 2:
+        return mean, 1
+    var = sum((d - mean)**2 for d in diffs)/(n - 1)/n
+    # If the decks haven't disagreed yet, that doesn't mean they never
+    # will. Don't claim to be more precise than one disagreement would.
+    var = max(var, 1/(n*n))
+    return mean, math.sqrt(var)
+
+
+def print_differences(results, max_turns, z=2):
+    """Each deck's rate, then its difference from the first deck."""
+    names = list(results)
+    baseline = results[names[0]]
+    namewidth = max(len(x) for x in names) + 1
+    header = "name".ljust(namewidth)
+    for turn in range(1, max_turns + 1):
+        header += f"| turn {turn} ".ljust(30)
+    print(header)
+    for name in names:
+        summaries = results[name]
+        line = name.ljust(namewidth)
+        for turn in range(1, max_turns + 1):
+            hits = sum(x["turns"].get(str(turn)) is True for x in summaries)
+            cell = output.pcts(hits, len(summaries), z=z)
+            if name != names[0]:
+                mean, err = difference(summaries, baseline, turn)
+                cell += f" ({signed_pct(mean)} ± {output.pct(z*err)})"
+            line += f"| {cell} ".ljust(30)
+        print(line)
+    print(f"Differences are against {names[0]}, trial by trial.")
+
+
+def signed_pct(x):
+    return "%+2.0f" % (100*x) + "%"
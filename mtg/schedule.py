@@ -0,0 +1,77 @@
+"""
+When comparing a bunch of decks, some of them settle down faster than
+others. Rather than picking a deck at random for each trial, keep a tally
+for each deck (starting from what's already in output/) and send the next
+trial wherever it does the most good. Once a deck's error bars are narrow
+enough, stop running it.
+"""
+
+import collections
+import math
+
+from . import output
+
+
+class Scheduler(object):
+
+    def __init__(self, names, max_turns, target, z=2):
+        self.names = list(names)
+        self.max_turns = max_turns
+        self.target = target
+        self.z = z
+        self.counts = {name: output.counts(name) for name in self.names}
+        # Trials handed out but not yet finished. They don't count towards
+        # the error bars, but we don't want to pile more onto the same deck
+        # in the meantime.
+        self.pending = collections.Counter()
+
+    def interval(self, name, turn):
+        counts = self.counts[name]
+        return output.interval(counts.titans[turn-1], max(counts.trials, 1), z=self.z)
+
+    def width(self, name):
+        """The widest error bar across all turns we're looking at."""
+        return max(
+            self.interval(name, turn)[1]
+            for turn in range(1, self.max_turns + 1)
+        )
+
+    def expected_width(self, name):
+        """Error bars shrink like one over the square root of the number of
+        trials. Guess where they'll be once the pending trials come in.
+        """
+        n = max(self.counts[name].trials, 1)
+        return self.width(name)*math.sqrt(n/(n + self.pending[name]))
+
+    def contested(self, name):
+        """Does this deck's error bar on the last turn overlap with that of
+        the deck just above or below it in the rankings?
+        """
+        turn = self.max_turns
+        ranked = sorted(self.names, key=lambda x: self.interval(x, turn)[0])
+        i = ranked.index(name)
+        p, dp = self.interval(name, turn)
+        for neighbor in ranked[max(i-1, 0):i] + ranked[i+1:i+2]:
+            q, dq = self.interval(neighbor, turn)
+            if abs(p - q) < dp + dq:
+                return True
+        return False
+
+    def choose(self):
+        """Pick a deck that hasn't hit the target yet. Decks that are still
+        neck and neck with a neighbor go first, then the widest error bars.
+        Return None once every deck is done.
+        """
+        todo = [x for x in self.names if self.width(x) > self.target]
+        if not todo:
+            return None
+        name = max(
+            todo,
+            key=lambda x: (self.contested(x), self.expected_width(x)),
+        )
+        self.pending[name] += 1
+        return name
+
+    def record(self, name, summary):
+        self.pending[name] -= 1
+        self.counts[name] = self.counts[name].add_record(output.encode(summary))
@@ -14,26 +14,182 @@ computation time.
 """
 
 import collections
+import functools
 import itertools
-import time
+import operator
 
-from .mana import Mana, set_colors
-from .card import Card, Cards
+from .mana import Mana, pareto_front, set_colors
+from .card import CARDS, Card, Cards, Deck, colors_needed, compile_card_data
+from .helpers import multiset_combinations
+from .notes import Notes
+from .budget import Budget
+from . import stats, vector
 
 # ======================================================================
 
-# Most of the hands that don't converge at 2e5 states also don't
-# converge at 5e5 states. How much time do you want to burn trying?
-MAX_STATES = 2e5
-MAX_SECONDS = 60
-N_STATES = 0
-START_TIME = None
-
 
 class TooManyStates(Exception):
     pass
 
 
+# Methods that do the most branching. Turning on instrumentation wraps each
+# of these so that we can see which cards are responsible for how much.
+INSTRUMENTED = ("bounce_land", "cast", "cycle", "pitch", "play", "sacrifice", "tap_out")
+
+
+def instrument():
+    """Start keeping counts (see the stats module). Wrapping the methods
+    only when asked means there's no cost the rest of the time.
+    """
+    if stats.ENABLED:
+        return
+    stats.ENABLED = True
+    for name in INSTRUMENTED:
+        setattr(GameState, name, counted(getattr(GameState, name)))
+
+
+def counted(method):
+    name = method.__name__
+
+    def wrapper(self, *args, **kwargs):
+        card = args[0].name if args and isinstance(args[0], Card) else ""
+        n_states = self.budget.states
+        states = method(self, *args, **kwargs)
+        stats.count(name, card, self.turn, "calls")
+        stats.count(name, card, self.turn, "built", self.budget.states - n_states)
+        stats.count(name, card, self.turn, "returned", len(states))
+        return states
+
+    wrapper.__name__ = name
+    return wrapper
+
+
+def count_action(action, turn, metric):
+    if stats.ENABLED:
+        method, card = action
+        stats.count(method, card.name if card else "", turn, metric)
+
+
+# ======================================================================
+
+# Partial-order reduction. Lots of actions within a turn commute: playing
+# a Forest then casting Amulet gets us to the same place as the other way
+# around. The closed set catches the duplicate position, but only after
+# we've already built it. Instead, each state carries a "sleep set" of
+# actions we know we don't need to take from there, because some other
+# ordering already covers them.
+
+NO_SLEEP = frozenset()
+COVERS = {}
+
+
+def covers(first, second):
+    """Does taking the first action, then the second, get us everything we
+    would get by taking them the other way around? We only say yes when
+    the card data tells us what the actions touch:
+
+    - Two spells that only put permanents onto the battlefield or add land
+      drops. Paying for them in either order leaves the same pools.
+    - A land that enters untapped and does nothing special, then a spell
+      that doesn't care about lands. The land's mana can help pay for the
+      spell, so playing it first gives at least as many options.
+    """
+    key = (first, second)
+    if key not in COVERS:
+        kinds = (first[0], second[0])
+        if kinds == ("cast", "cast"):
+            COVERS[key] = simple_cast(first[1]) and simple_cast(second[1])
+        elif kinds == ("play", "cast"):
+            COVERS[key] = simple_land(first[1]) and ignores_lands(second[1])
+        else:
+            COVERS[key] = False
+    return COVERS[key]
+
+
+def ignores_lands(card):
+    touches = card.cast_touches
+    return touches is not None and "lands" not in touches
+
+
+def simple_cast(card):
+    touches = card.cast_touches
+    return touches is not None and touches <= {"battlefield", "land_drops"}
+
+
+def simple_land(card):
+    # Lands that enter tapped care how many Amulets we have.
+    return not card.enters_tapped and handler("play", card) is None
+
+
+# ======================================================================
+
+# What each card does when we cast it, cycle it, play it, or sacrifice it.
+# Simple effects are spelled out in carddata.yaml (on_cast, on_cycle, and
+# so on) as a comma-separated list of steps. Anything fancier is a method
+# on GameState named after the card, like cast_summoners_pact. Either way,
+# we look each one up once and hang on to it.
+
+HANDLERS = {}
+
+
+def handler(kind, card):
+    """Return a function that takes a GameState and returns the
+    GameStates that result from the card's effect, or None if the card
+    doesn't do anything special.
+    """
+    key = (kind, card.index)
+    if key not in HANDLERS:
+        effect = CARDS.get(card.name, {}).get("on_" + kind)
+        if effect is not None:
+            HANDLERS[key] = compile_effect(card, effect)
+        else:
+            HANDLERS[key] = getattr(GameState, kind + "_" + card.slug, None)
+    return HANDLERS[key]
+
+
+def compile_effect(card, effect):
+    steps = [compile_step(card, x.split()) for x in effect.split(",")]
+    if len(steps) == 1:
+        return steps[0]
+
+    def func(state):
+        states = GameStates([state])
+        for step in steps:
+            states = states.apply(step)
+        return states
+    return func
+
+
+def compile_step(card, words):
+    # Refer to the card by name. Variants like "Sakura-Tribe Scout*" share
+    # an index, so the Card we were compiled for might not be the one the
+    # deck uses.
+    name = card.name
+    verb, args = words[0], words[1:]
+    if verb == "add":
+        return lambda state: state.add_mana(args[0])
+    elif verb == "bounce":
+        return lambda state: state.bounce_land()
+    elif verb == "dig":
+        return lambda state: state.dig(int(args[0]), args[1])
+    elif verb == "done":
+        return lambda state: state.clone(done=True)
+    elif verb == "draw":
+        return lambda state: state.draw(int(args[0]))
+    elif verb == "fetch":
+        tapped = "tapped" in args[1:] or None
+        return lambda state: state.fetch(args[0], tapped=tapped)
+    elif verb == "land_drops":
+        return lambda state: state.clone(land_drops=state.land_drops + int(args[0]))
+    elif verb == "permanent":
+        return lambda state: state.clone(battlefield=state.battlefield + name)
+    elif verb == "scry":
+        return lambda state: state.scry(int(args[0]))
+    elif verb == "suspend":
+        return lambda state: state.suspend(name, int(args[0]))
+    raise ValueError(f"unknown effect {verb!r} for {name}")
+
+
 class GameStates(set):
     """A set of GameState objects. Passes method calls on to its
     elements and aggregates the results.
@@ -47,10 +203,12 @@ class GameStates(set):
             return new_states
         return func
 
-    def safe_getattr(self, attr):
-        if not all(hasattr(x, attr) for x in self):
-            return self
-        return getattr(self, attr)()
+    def apply(self, func):
+        """Call a function on each state and collect the results."""
+        new_states = GameStates()
+        for state in self:
+            new_states |= func(state)
+        return new_states
 
     def report(self):
         if len(self) == 1:
@@ -60,7 +218,7 @@ class GameStates(set):
         # look at the longest one I guess? The most actions to evaluate.
         else:
             longest_state = max(self, key=len)
-            return longest_state.report() + f"\nFailed to converge after {N_STATES} states"
+            return longest_state.report() + f"\nFailed to converge after {longest_state.budget.states} states"
 
     @property
     def performance(self):
@@ -92,10 +250,28 @@ class GameStates(set):
         for state in self:
             return state.turn
 
+    def first_solution(self, **kwargs):
+        # Share the transposition table between all starting states.
+        visited = {}
+        dominance = collections.defaultdict(list)
+        for state in self:
+            solution = state.first_solution(
+                visited=visited, dominance=dominance, **kwargs
+            )
+            if solution is not None:
+                return GameStates([solution])
+        return GameStates()
+
     def next_turn(self, **kwargs):
         next_states = GameStates()
+        # Share the closed set between all starting states. Different lines
+        # last turn can easily converge on the same position this turn.
+        expanded = {}
+        dominance = collections.defaultdict(list)
         for state in self:
-            for _state in state.next_turn(**kwargs):
+            for _state in state.next_turn(
+                expanded=expanded, dominance=dominance, **kwargs
+            ):
                 if _state.overflowed:
                     return GameStates([_state])
                 # As soon as we find a solution, bail.
@@ -106,39 +282,76 @@ class GameStates(set):
                 # In the event of an overflow, bail. If we've got a solution,
                 # report it. Otherwise, dump the longest state we have. That
                 # might give us a sense for what's problematic.
-                dt = time.time() - START_TIME
-                if N_STATES > MAX_STATES or dt > MAX_SECONDS:
+                if _state.budget.exhausted():
                     longest_state = max(next_states, key=len).overflow()
                     print("### OVERFLOW ###")
                     print(longest_state.report())
                     raise TooManyStates
-        return next_states
+        return next_states.prune_dominated()
+
+    def prune_dominated(self):
+        """Drop any state that another state in the set dominates."""
+        if vector.ENABLED and len(self) >= vector.MIN_STATES:
+            if vector.CHECK:
+                return vector.check(self, self.prune_pairwise())
+            states = GameStates(vector.prune_dominated(self))
+            next(iter(self)).budget.dominated += len(self) - len(states)
+            return states
+        return self.prune_pairwise()
+
+    def prune_pairwise(self):
+        """Same as prune_dominated, one pair of states at a time."""
+        dominance = collections.defaultdict(list)
+        states = GameStates()
+        for state in self:
+            if not state.is_dominated(dominance, states):
+                states.add(state)
+        return states
 
 
 # ======================================================================
 
 
 GAME_STATE_DEFAULTS = {
+    # Shared by every state in the same search, along with the deck list
+    # (which never changes, so it lives in the budget rather than in each
+    # state). Doesn't count towards comparing states.
+    "budget": None,
     # No need to distinguish tapped from untapped since we tap
     # everything immediately
     "battlefield": (),
-    "deck_list": (),
     "deck_index": 0,
     "done": False,
     "hand": (),
     "mana_debt": Mana(),
     "mana_pool": Mana(),
-    "notes": "",
+    "notes": Notes(),
     "on_the_play": False,
     "overflowed": False,
     "land_drops": 0,
     "spells_cast": 0,
     "suspended": (),
     "turn": 0,
+    # Hash of everything else that counts towards comparing states. Rather
+    # than hashing every field each time a state goes into a set, clone
+    # keeps this up to date as fields change.
+    "zobrist": None,
 }
 
 
 FIELDS = sorted(GAME_STATE_DEFAULTS.keys())
+FIELD_INDEX = {k: i for i, k in enumerate(FIELDS)}
+ZOBRIST = FIELD_INDEX["zobrist"]
+# The fields that count towards comparing states, by position. Each one's
+# share of the hash is hash((position, value)), and the state's hash is all
+# of those XORed together, so swapping out one field's share is cheap.
+# Hashing the names instead would give different hashes from run to run,
+# and search order (so where a hand overflows) depends on the hashes.
+COMPARED_INDEX = {
+    k: i for i, k in enumerate(FIELDS)
+    if k not in ("budget", "notes", "zobrist")
+}
+compared = operator.itemgetter(*COMPARED_INDEX.values())
 
 
 GameStateBase = collections.namedtuple("GameStateBase", " ".join(FIELDS))
@@ -146,111 +359,360 @@ GameStateBase = collections.namedtuple("GameStateBase", " ".join(FIELDS))
 
 class GameState(GameStateBase):
 
-    def __new__(cls, reset_clock=False, **kwargs):
-        global N_STATES, START_TIME
-        if reset_clock:
-            N_STATES = 0
-            START_TIME = time.time()
-            colors = kwargs.pop("colors", "WUBRG")
+    # There are a lot of these. Don't give each one a __dict__.
+    __slots__ = ()
+
+    def __new__(cls, new_search=False, **kwargs):
+        if new_search:
+            if kwargs.get("budget") is None:
+                kwargs["budget"] = Budget()
+            # The deck is the one place where order matters.
+            deck_list = Deck(kwargs.pop("deck_list", ()))
+            kwargs["budget"].deck_list = deck_list
+            # Unless the deck list says otherwise, only keep track of colors
+            # that something in the deck might need.
+            colors = kwargs.pop("colors", None)
+            if colors is None:
+                colors = colors_needed(deck_list)
             set_colors(colors)
-            kwargs["notes"] = f"tracking colors: {colors}"
-        else:
-            N_STATES += 1
+            compile_card_data()
+            kwargs["notes"] = Notes("tracking colors: {}", colors)
+        elif kwargs.get("budget") is not None:
+            kwargs["budget"].states += 1
         new_kwargs = GAME_STATE_DEFAULTS.copy()
         new_kwargs.update(kwargs)
-        for key in ("hand", "deck_list", "battlefield"):
+        for key in ("hand", "battlefield"):
             if not isinstance(new_kwargs[key], Cards):
                 new_kwargs[key] = Cards(new_kwargs[key])
-        values = [v for k, v in sorted(new_kwargs.items())]
-        return GameStateBase.__new__(cls, *values)
+        if new_kwargs["zobrist"] is None:
+            new_kwargs["zobrist"] = functools.reduce(
+                operator.xor, (hash((i, new_kwargs[k])) for k, i in COMPARED_INDEX.items())
+            )
+        return tuple.__new__(cls, [new_kwargs[k] for k in FIELDS])
 
     def __hash__(self):
         """Ignore notes when collapsing duplicates."""
-        fields = []
-        for i, fieldname in enumerate(FIELDS):
-            if fieldname in ("notes", "deck_list"):
-                continue
-            fields.append(self[i])
-        return tuple.__hash__(tuple(fields))
+        return self.zobrist
 
     def __eq__(self, other):
-        """Ignore notes when collapsing duplicates."""
-        for i, fieldname in enumerate(FIELDS):
-            if fieldname in ("notes", "deck_list"):
-                continue
-            if self[i] != other[i]:
-                return False
-        return True
+        """Ignore notes when collapsing duplicates. Sets only get this far
+        when the hashes match, so this is almost always a real duplicate.
+        """
+        return self.zobrist == other.zobrist and compared(self) == compared(other)
 
     def __len__(self):
-        return self.notes.count("\n")
+        return len(self.notes)
 
-    def clone(self, **kwargs):
-        new_kwargs = self._asdict()
-        new_kwargs.update(kwargs)
-        return GameStates([GameState(**new_kwargs)])
+    @property
+    def deck_list(self):
+        return self.budget.deck_list
+
+    def __reduce__(self):
+        """Skip the constructor when unpickling. The state has already
+        been built (and counted).
+        """
+        return (tuple.__new__, (GameState, tuple(self)))
+
+    def rebind(self, budget):
+        """The same state, counted against a different budget. Doesn't
+        count as a new state.
+        """
+        values = [budget if k == "budget" else v for k, v in zip(FIELDS, self)]
+        return tuple.__new__(GameState, values)
+
+    def dominance_key(self):
+        """Two states can only dominate one another if these all match."""
+        return (
+            self.battlefield,
+            self.deck_index,
+            self.done,
+            self.on_the_play,
+            self.overflowed,
+            self.spells_cast,
+            self.suspended,
+            self.turn,
+        )
 
-    def next_states(self, max_turns):
-        # If this goose is already cooked, don't iterate further
-        if self.overflowed or self.done:
-            return GameStates([self])
-        states = GameStates()
+    def dominates(self, other):
+        """Assumes the dominance keys already match. Anything the other
+        state can do, this one can do too: the same board, at least as much
+        mana, as many land drops, no more debt, and at least the same cards
+        in hand. Strictly speaking, an extra Once Upon a Time in hand isn't
+        always better, because we force it to be cast first. But that
+        shortcut already assumes it is.
+        """
+        return (
+            self.mana_pool >= other.mana_pool and
+            self.land_drops >= other.land_drops and
+            self.mana_debt <= other.mana_debt and
+            self.hand.issuperset(other.hand)
+        )
+
+    def dominance_value(self):
+        """The parts of the state that dominates compares. Small enough to
+        keep around after the state itself is gone.
+        """
+        return (self.mana_pool, self.land_drops, self.mana_debt, self.hand)
+
+    def is_covered(self, dominance):
+        """Same as is_dominated, for the depth-first search. Its table holds
+        dominance values rather than whole states, so it doesn't keep every
+        state's log alive. Nothing gets pulled off the stack, so there's no
+        old_states to update.
+        """
+        group = dominance[self.dominance_key()]
+        pool, drops, debt, hand = value = self.dominance_value()
+        # Same comparisons as dominates.
+        for other_pool, other_drops, other_debt, other_hand in group:
+            if (
+                other_pool >= pool and
+                other_drops >= drops and
+                other_debt <= debt and
+                other_hand.issuperset(hand)
+            ):
+                self.budget.dominated += 1
+                return True
+        group[:] = [
+            x for x in group
+            if not (
+                pool >= x[0] and
+                drops >= x[1] and
+                debt <= x[2] and
+                hand.issuperset(x[3])
+            )
+        ]
+        group.append(value)
+        return False
+
+    def is_dominated(self, dominance, old_states=()):
+        """Check this state against the dominance table, which groups the
+        states we've seen so far by dominance key. If this state is no
+        better than one of them, we can skip it. Otherwise, it goes in the
+        table, and anything it dominates comes out (and is dropped from
+        old_states, if it's waiting there to be expanded).
+        """
+        group = dominance[self.dominance_key()]
+        for state in group:
+            if state.dominates(self):
+                self.budget.dominated += 1
+                return True
+        worse = [x for x in group if self.dominates(x)]
+        for state in worse:
+            group.remove(state)
+            if state in old_states:
+                old_states.discard(state)
+                self.budget.dominated += 1
+        group.append(self)
+        return False
+
+    def clone(self, **kwargs):
+        """Copy this state, changing just the given fields. Everything else
+        is shared with this one. We do this for every state we build, so
+        skip the defaults and conversions in __new__ and go straight to
+        the tuple.
+        """
+        values = list(self)
+        # Swap out the hash for just the fields that changed.
+        h = self.zobrist
+        for key, value in kwargs.items():
+            i = FIELD_INDEX[key]
+            if key in COMPARED_INDEX:
+                if key in ("hand", "battlefield") and not isinstance(value, Cards):
+                    value = Cards(value)
+                h ^= hash((i, values[i])) ^ hash((i, value))
+            values[i] = value
+        values[ZOBRIST] = h
+        if self.budget is not None:
+            self.budget.states += 1
+        return GameStates([tuple.__new__(GameState, values)])
+
+    def actions(self, max_turns):
+        """Everything we might try from here, as (method, card) pairs.
+        Lands come before spells, which partial-order reduction counts on.
+        """
+        actions = []
         if self.turn != max_turns:
-            states |= self.pass_turn()
+            actions.append(("pass_turn", None))
         for card in set(self.hand.lands()):
-            states |= self.play(card)
+            actions.append(("play", card))
         # If OUAT is in our hand, make sure we cast it before casting anything
         # else. Turns out this has a huge performance impact!
         if self.spells_cast == 0 and "Once Upon a Time" in self.hand:
-            states |= self.cycle(Card("Once Upon a Time"))
-            return states
+            actions.append(("cycle", Card("Once Upon a Time")))
+            return actions
         for card in set(self.hand):
-            states |= self.cast(card)
-            states |= self.cycle(card)
+            actions.append(("cast", card))
+            actions.append(("cycle", card))
         for card in set(self.battlefield):
-            states |= self.sacrifice(card)
+            actions.append(("sacrifice", card))
+        return actions
+
+    def take(self, action):
+        method, card = action
+        if card is None:
+            return getattr(self, method)()
+        return getattr(self, method)(card)
+
+    def next_states(self, max_turns):
+        states = GameStates()
+        for state, _, _ in self.successors(max_turns):
+            states.add(state)
         return states
 
-    def next_turn(self, max_turns):
+    def successors(self, max_turns, sleep=NO_SLEEP, woken=None):
+        """Yield each state we can get to from here, along with its sleep
+        set and the action that got it there. Skip anything that's already
+        asleep. If we've been here
+        before, woken says which actions were asleep then but aren't now.
+        Those are the only ones we still need to try.
+        """
+        # If this goose is already cooked, don't iterate further
+        if self.overflowed or self.done:
+            yield self, NO_SLEEP, None
+            return
+        taken = []
+        for action in self.actions(max_turns):
+            if action in sleep:
+                continue
+            if woken is not None and action not in woken:
+                continue
+            # Anything we've already tried (or were told to skip) that
+            # covers this action doesn't need to be tried after it. Only
+            # spells can be covered, so don't bother checking others.
+            if action[0] == "cast" and ignores_lands(action[1]):
+                new_sleep = frozenset(
+                    x for x in itertools.chain(sleep, taken) if covers(x, action)
+                )
+            else:
+                new_sleep = NO_SLEEP
+            states = self.take(action)
+            # An action that can't be taken (like a land with no land drops
+            # left) doesn't cover anything.
+            if states:
+                taken.append(action)
+            for state in states:
+                yield state, new_sleep, action
+
+    def next_turn(self, max_turns, expanded=None, dominance=None):
         if self.turn == max_turns:
             old_states = GameStates()
         else:
             old_states = GameStates([self])
+        # Sleep sets for the states waiting to be expanded.
+        sleeps = {}
+        # Keep track of the states we've already expanded this turn. The
+        # same position can come up by playing the same cards in a different
+        # order, and there's no reason to look at it twice. To keep this
+        # small, we only hold on to each state's 64-bit hash (and the sleep
+        # set it was expanded with).
+        if expanded is None:
+            expanded = {}
+        # Likewise, if we've already seen a state that's at least as good as
+        # this one, there's no reason to look at this one at all.
+        if dominance is None:
+            dominance = collections.defaultdict(list)
         # For each state, look at all the possible next states. Keep iterating
         # until each passes the turn.
         while old_states:
-            for state in old_states.pop().next_states(max_turns=max_turns):
+            old_state = old_states.pop()
+            sleep = sleeps.pop(old_state, NO_SLEEP)
+            fingerprint = hash(old_state)
+            # If we've been here before, we only need to go again if some
+            # action was asleep then but isn't now.
+            woken = None
+            if fingerprint in expanded:
+                woken = expanded[fingerprint] - sleep
+                if not woken:
+                    self.budget.repeats += 1
+                    continue
+                sleep &= expanded[fingerprint]
+            expanded[fingerprint] = sleep
+            for state, state_sleep, action in old_state.successors(max_turns, sleep, woken):
+                fingerprint = hash(state)
                 # If this one is done, stop iterating
                 if state.overflowed or state.done:
                     yield state
                 if state.turn > self.turn:
                     yield state
-                else:
+                elif state in old_states:
+                    sleeps[state] = sleeps.get(state, NO_SLEEP) & state_sleep
+                    count_action(action, self.turn, "repeats")
+                elif fingerprint in expanded:
+                    if expanded[fingerprint] <= state_sleep:
+                        self.budget.repeats += 1
+                        count_action(action, self.turn, "repeats")
+                    else:
+                        old_states.add(state)
+                        sleeps[state] = state_sleep
+                elif not state.is_dominated(dominance, old_states):
                     old_states.add(state)
+                    sleeps[state] = state_sleep
+                else:
+                    count_action(action, self.turn, "dominated")
+
+    def first_solution(self, max_turns, visited=None, dominance=None):
+        """Depth-first search for a winning line. Rather than building out
+        every state for a turn before looking at the next one, follow each
+        line as far as it goes and bail as soon as we find one that works.
+        The stack scales with the depth of the search rather than the width
+        of the frontier. The transposition and dominance tables still grow
+        with the number of states visited, but they only keep hashes and
+        dominance values, not the states themselves. Returns the winning
+        state, or None if there isn't one by max_turns.
+        """
+        # States we've already looked at, by hash. Same idea as the closed
+        # set in next_turn, but it spans turns as well.
+        if visited is None:
+            visited = {}
+        if dominance is None:
+            dominance = collections.defaultdict(list)
+        # Along with each state, keep track of how we got there (the action
+        # and the turn it was taken on) for instrumentation.
+        stack = [(self, NO_SLEEP, None, None)]
+        while stack:
+            state, sleep, action, turn = stack.pop()
+            if state.done:
+                return state
+            fingerprint = hash(state)
+            woken = None
+            if fingerprint in visited:
+                woken = visited[fingerprint] - sleep
+                if not woken:
+                    self.budget.repeats += 1
+                    if action:
+                        count_action(action, turn, "repeats")
+                    continue
+                sleep &= visited[fingerprint]
+            elif state.is_covered(dominance):
+                if action:
+                    count_action(action, turn, "dominated")
+                continue
+            visited[fingerprint] = sleep
+            if self.budget.exhausted():
+                print("### OVERFLOW ###")
+                print(state.overflow().report())
+                raise TooManyStates
+            for child, child_sleep, action in state.successors(max_turns, sleep, woken):
+                stack.append((child, child_sleep, action, state.turn))
+        return None
 
     def overflow(self):
         return self.clone(overflowed=True)
 
     @property
     def performance(self):
-        dt = time.time() - START_TIME
-        return "%4.0fk states / %3.0f s = %4.0fk states/s" % (
-            N_STATES/1000,
-            dt,
-            N_STATES/1000/dt,
-        )
+        return self.budget.performance
 
     def report(self):
-        return self.notes.lstrip(", \n")
+        return str(self.notes).lstrip(", \n")
 
     # ------------------------------------------------------------------
 
     def add_mana(self, m, note=""):
         pool = self.mana_pool + m
-        note += f", {pool} in pool"
         return self.clone(
             mana_pool=pool,
-            notes=self.notes + note
+            notes=self.notes.add(note).add(", {} in pool", pool),
         )
 
     def bounce_land(self):
@@ -259,7 +721,7 @@ class GameState(GameStateBase):
         # Choices for what to bounce are trickier.
         for card in self.battlefield.lands():
             states |= self.clone(
-                notes=self.notes + f", bounce {card}",
+                notes=self.notes.add(", bounce {}", card),
                 battlefield=self.battlefield - card,
                 hand=self.hand + card,
             )
@@ -271,19 +733,27 @@ class GameState(GameStateBase):
             return GameStates()
         states = self.clone(
             hand=self.hand - card,
-            notes=self.notes + f"\ncast {card}",
+            notes=self.notes.add("\ncast {}", card),
             spells_cast=self.spells_cast + 1,
         ).pay(cost)
-        # Don't use the safety wrapper. If casting is a no-op, we
-        # shouldn't be casting. And something is probably wrong.
-        return getattr(states, "cast_" + card.slug)()
+        # If casting is a no-op, we shouldn't be casting. Something is
+        # probably wrong.
+        func = handler("cast", card)
+        if func is None:
+            raise ValueError(f"no cast effect for {card}")
+        return states.apply(func)
 
     def cast_from_suspend(self, card):
         states = self.clone(
-            notes=self.notes + f", cast {card} from suspend",
+            notes=self.notes.add(", cast {} from suspend", card),
             spells_cast=self.spells_cast + 1,
         )
-        return getattr(states, "cast_" + card.slug)()
+        # If casting is a no-op, we shouldn't be casting. Something is
+        # probably wrong.
+        func = handler("cast", card)
+        if func is None:
+            raise ValueError(f"no cast effect for {card}")
+        return states.apply(func)
 
     def cycle(self, card):
         cost = card.cycle_cost
@@ -291,21 +761,29 @@ class GameState(GameStateBase):
             return GameStates()
         states = self.clone(
             hand=self.hand - card,
-            notes=self.notes + f"\n{card.cycle_verb} {card}",
+            notes=self.notes.add("\n{} {}", card.cycle_verb, card),
         ).pay(cost)
-        return states.safe_getattr("cycle_" + card.slug)
+        func = handler("cycle", card)
+        return states.apply(func) if func else states
+
+    def dig(self, n, kind):
+        """Look at the top n cards and take one of the given kind (as in
+        Cards.lands, Cards.permanents, and so on), if there is one.
+        """
+        return self.mill(n).grabs(getattr(self.top(n), kind)(best=True))
 
     def draw(self, n):
+        top = self.top(n)
         return self.clone(
             deck_index=self.deck_index + n,
-            hand=self.hand + self.top(n),
-            notes=self.notes + f", draw {self.top(n)}",
+            hand=self.hand + top,
+            notes=self.notes.add(", draw {}", top),
         )
 
     def fetch(self, card, tapped=None):
         card = Card(card)
         state = self.clone(
-            notes=self.notes + f", fetch {card}",
+            notes=self.notes.add(", fetch {}", card),
             battlefield=self.battlefield,
             hand=self.hand + card,
         )
@@ -317,24 +795,25 @@ class GameState(GameStateBase):
     def grab(self, card):
         return self.clone(
             hand=self.hand + card,
-            notes=self.notes + f", grab {card}",
+            notes=self.notes.add(", grab {}", card),
         )
 
     def grabs(self, cards):
         states = GameStates()
-        for card in cards:
+        # Grabbing either copy of a card gets to the same place.
+        for card in dict.fromkeys(cards):
             states |= self.grab(card)
         return states
 
     def mill(self, n):
         return self.clone(
             deck_index=self.deck_index + n,
-            notes=self.notes + f", mill {self.top(n)}",
+            notes=self.notes.add(", mill {}", self.top(n)),
         )
 
-    def note(self, note):
+    def note(self, note, *args):
         return self.clone(
-            notes=self.notes + note,
+            notes=self.notes.add(note, *args),
         )
 
     def pass_turn(self):
@@ -349,7 +828,7 @@ class GameState(GameStateBase):
         creatures_killed = Cards([x for x in self.battlefield if x.dies])
         if creatures_killed:
             state = self.clone(
-                notes=self.notes + f"\nopponent kills {creatures_killed}",
+                notes=self.notes.add("\nopponent kills {}", creatures_killed),
                 battlefield=self.battlefield - creatures_killed,
             ).pop()
         else:
@@ -365,7 +844,7 @@ class GameState(GameStateBase):
             mana_debt=Mana(),
             mana_pool=Mana(),
             turn=self.turn+1,
-        ).note(f"\n---- turn {self.turn+1}").tap_out()
+        ).note("\n---- turn {}", self.turn+1).tap_out()
         # Watch out for pre-game actions, like Gemstone Caverns and Chancellor
         # of the Tangle
         if self.turn == 0:
@@ -384,7 +863,7 @@ class GameState(GameStateBase):
         for m in self.mana_pool.minus(cost):
             states |= self.clone(
                 mana_pool=m,
-                notes=self.notes + note,
+                notes=self.notes.add(note),
             )
         return states
 
@@ -393,10 +872,10 @@ class GameState(GameStateBase):
         if options is None:
             options = self.hand
         states = GameStates()
-        for cards in itertools.combinations(options, n):
+        for cards in multiset_combinations(options, n):
             states |= self.clone(
                 hand=self.hand - cards,
-                notes=self.notes + f", discard {Cards(cards)}",
+                notes=self.notes.add(", discard {}", Cards(cards)),
             )
         return states
 
@@ -406,12 +885,12 @@ class GameState(GameStateBase):
         if not self.land_drops or not card in self.hand:
             return GameStates()
         states = self.clone(
-            notes=self.notes + f"\nplay {card}",
+            notes=self.notes.add("\nplay {}", card),
             land_drops=self.land_drops - 1,
         )
         enters_tapped = card.enters_tapped
         if enters_tapped == "check":
-            enters_tapped = getattr(self, "check_" + card.slug)()
+            enters_tapped = handler("check", card)(self)
         if enters_tapped:
             return states.play_tapped(card, **kwargs)
         else:
@@ -421,28 +900,30 @@ class GameState(GameStateBase):
         states = self.clone(
             battlefield=self.battlefield + card,
             hand=self.hand - card,
-            notes=self.notes + note,
+            notes=self.notes.add(note),
         )
         for _ in range(self.battlefield.count("Amulet of Vigor")):
             states = states.tap(card, **kwargs)
-        return states.safe_getattr("play_" + card.slug)
+        func = handler("play", card)
+        return states.apply(func) if func else states
 
     def play_untapped(self, card, **kwargs):
         states = self.clone(
             hand=self.hand - card,
             battlefield=self.battlefield + card,
         ).tap(card, **kwargs)
-        return states.safe_getattr("play_" + card.slug)
+        func = handler("play", card)
+        return states.apply(func) if func else states
 
     def pre_game_actions(self):
         # Gemstone Caverns. Keep in mind that exiling nothing is allowed.
         if Card("Gemstone Caverns") in self.hand and not self.on_the_play:
-            states = self.note(f", ignore {Card('Gemstone Caverns')}")
+            states = self.note(", ignore {}", Card("Gemstone Caverns"))
             for card in self.hand - "Gemstone Caverns":
                 states |= self.clone(
                     hand=self.hand - Cards(["Gemstone Caverns", card]),
                     battlefield=self.battlefield + Card("Gemstone Mine"),
-                    notes=self.notes + f", cheat out {Card('Gemstone Caverns')} with {card}",
+                    notes=self.notes.add(", cheat out {} with {}", Card("Gemstone Caverns"), card),
                 )
             return states
         else:
@@ -454,41 +935,37 @@ class GameState(GameStateBase):
             return GameStates()
         states = self.clone(
             battlefield=self.battlefield - card,
-            notes=self.notes + f"\nsacrifice {card}",
+            notes=self.notes.add("\nsacrifice {}", card),
         ).pay(cost)
-        return getattr(states, "sacrifice_" + card.slug)()
+        func = handler("sacrifice", card)
+        if func is None:
+            raise ValueError(f"no sacrifice effect for {card}")
+        return states.apply(func)
 
     def scry(self, n):
         if n == 1:
             return self.mill(1) | self.clone(
-                notes=self.notes + f", leave {self.top(1)}",
+                notes=self.notes.add(", leave {}", self.top(1)),
             )
         else:
             raise ValueError("Scrying 2+ cards is not supported")
 
-    def safe_getattr(self, attr):
-        try:
-            func = getattr(states, "cast_" + card.slug)
-        except AttributeError:
-            return GameStates([self])
-        return func()
-
     def suspend(self, card, n):
         return self.clone(
-            suspended=self.suspended + ((Card(card), n),),
+            suspended=tuple(sorted(self.suspended + ((Card(card), n),))),
         )
 
     def tap(self, card, silent=False):
         states = GameStates()
         for m in card.taps_for:
             mana_pool = self.mana_pool + m
-            if m and not silent:
-                mana_note = f", {mana_pool} in pool" if mana_pool else ""
+            if m and not silent and mana_pool:
+                notes = self.notes.add(", {} in pool", mana_pool)
             else:
-                mana_note = ""
+                notes = self.notes
             states |= self.clone(
                 mana_pool=mana_pool,
-                notes=self.notes + mana_note,
+                notes=notes,
             )
         return states or GameStates([self])
 
@@ -500,13 +977,14 @@ class GameState(GameStateBase):
             mana_options = card.taps_for
             for m in mana_options:
                 new_pools |= {pool+m for pool in pools}
-            pools, new_pools = new_pools, set()
+            # Different lands can give the same colors in different ways.
+            # Only keep the pools that aren't strictly worse than another.
+            pools, new_pools = pareto_front(new_pools), set()
         states = GameStates()
         for pool in pools:
-            mana_note = f", {pool} in pool" if pool else ""
             states |= self.clone(
                 mana_pool=pool,
-                notes=self.notes + mana_note,
+                notes=self.notes.add(", {} in pool", pool) if pool else self.notes,
             )
         return states
 
@@ -525,7 +1003,7 @@ class GameState(GameStateBase):
         if suspended:
             states = self.clone(
                 suspended=tuple(sorted(suspended)),
-                notes=self.notes + f", {tick_notes} ticking down",
+                notes=self.notes.add(", {} ticking down", tick_notes),
             )
         else:
             states = self
@@ -534,21 +1012,12 @@ class GameState(GameStateBase):
         return states
 
     def top(self, n):
-        return Cards(self.deck_list[self.deck_index:self.deck_index + n])
+        budget = self.budget
+        budget.deepest = max(budget.deepest, self.deck_index + n)
+        return Cards(budget.deck_list[self.deck_index:self.deck_index + n])
 
     # ------------------------------------------------------------------
 
-    def cast_adventurous_impulse(self):
-        return self.cast_oath_of_nissa()
-
-    def cast_amulet_of_vigor(self):
-        return self.clone(
-            battlefield=self.battlefield + "Amulet of Vigor",
-        )
-
-    def cast_ancient_stirrings(self):
-        return self.mill(5).grabs(self.top(5).colorless(best=True))
-
     def cast_arboreal_grazer(self):
         states = GameStates()
         for card in self.hand.lands():
@@ -564,12 +1033,6 @@ class GameState(GameStateBase):
             land_drops=self.land_drops + 2,
         )
 
-    def cast_beneath_the_sands(self):
-        return self.cast_sakura_tribe_elder()
-
-    def cast_bond_of_flourishing(self):
-        return self.mill(3).grabs(self.top(3).permanents(best=True))
-
     def cast_debug_titan(self):
         return self.clone(done=True)
 
@@ -585,54 +1048,14 @@ class GameState(GameStateBase):
             states |= self.mill(5).grab(land).play_tapped(land)
         return states
 
-    def cast_explore(self):
-        return self.clone(land_drops=self.land_drops+1).draw(1)
-
-    def cast_growth_spiral(self):
-        return self.cast_explore()
-
     def cast_llanowar_visionary(self):
         return self.clone(
             battlefield=self.battlefield + "Llanowar Visionary",
         ).draw(1)
 
-    def cast_oath_of_nissa(self):
-        return self.mill(3).grabs(self.top(3).creatures_lands(best=True))
-
     def have(self, card):
         return card in self.hand or card in self.battlefield
 
-    def cast_once_upon_a_time(self):
-        return self.mill(5).grabs(self.top(5).creatures_lands(best=True))
-
-    def cast_opt(self):
-        return self.scry(1).draw(1)
-
-    def cast_primeval_titan(self):
-        return self.clone(done=True)
-
-    def cast_pyretic_ritual(self):
-        return self.add_mana("RRR")
-
-    def cast_relic_of_progenitus(self):
-        return self.clone(
-            battlefield=self.battlefield + "Relic of Progenitus",
-        )
-
-    def cast_sakura_tribe_elder(self):
-        return self.fetch("Forest", tapped=True)
-
-    def cast_sakura_tribe_scout(self):
-        return self.clone(
-            battlefield=self.battlefield + "Sakura-Tribe Scout",
-        )
-
-    def cast_search_for_tomorrow(self):
-        return self.fetch("Forest")
-
-    def cast_summer_bloom(self):
-        return self.clone(land_drops=self.land_drops + 3)
-
     def cast_summoners_pact(self):
         states = GameStates()
         for card in self.deck_list.green_creatures():
@@ -647,7 +1070,9 @@ class GameState(GameStateBase):
             if not self.have("Amulet of Vigor") and card != "Primeval Titan":
                 continue
             states |= self.grab(card)
-        return states.clone(mana_debt=self.mana_debt + "2GG")
+        return states.clone(
+            mana_debt=self.mana_debt + Card("Summoner's Pact").pact_cost,
+        )
 
     def cast_through_the_breach(self):
         if "Primeval Titan" not in self.hand:
@@ -668,23 +1093,12 @@ class GameState(GameStateBase):
         else:
             return Card("Dryad of the Ilysian Grove") not in self.battlefield
 
-    def cycle_beneath_the_sands(self):
-        return self.draw(1)
-
-    def cycle_ketria_triome(self):
-        return self.draw(1)
-
     def cycle_once_upon_a_time(self):
         # Only allowed if this is the first spell we have cast all game.
         if self.spells_cast:
             return GameStates()
-        return self.clone(spells_cast=self.spells_cast+1).cast_once_upon_a_time()
-
-    def cycle_search_for_tomorrow(self):
-        return self.suspend("Search for Tomorrow", 2)
-
-    def cycle_simian_spirit_guide(self):
-        return self.add_mana("R")
+        states = self.clone(spells_cast=self.spells_cast+1)
+        return states.apply(handler("cast", Card("Once Upon a Time")))
 
     def cycle_tolaria_west(self):
         # Never transmute Tolaria West for another copy of itself, or for a
@@ -692,38 +1106,20 @@ class GameState(GameStateBase):
         options = Cards(["Summoner's Pact", "Simic Growth Chamber"])
         return self.grabs(self.deck_list.zeros() & options)
 
-    def cycle_tranquil_thicket(self):
-        return self.draw(1)
-
-    def play_boros_garrison(self):
-        return self.bounce_land()
-
-    def play_crumbling_vestige(self):
-        return self.add_mana("G")
-
     def play_lotus_field(self):
         lands = [x for x in self.battlefield if "land" in x.types]
         if len(lands) > 2:
-            to_sacrifice = itertools.combinations(lands, 2)
+            to_sacrifice = multiset_combinations(lands, 2)
         else:
             to_sacrifice = [lands]
         states = GameStates()
         for ts in to_sacrifice:
             states |= self.clone(
                 battlefield=self.battlefield - ts,
-                notes=self.notes + f", sacrifice {Cards(ts)}"
+                notes=self.notes.add(", sacrifice {}", Cards(ts)),
             )
         return states
 
-    def play_selesnya_sanctuary(self):
-        return self.bounce_land()
-
-    def play_simic_growth_chamber(self):
-        return self.bounce_land()
-
-    def play_temple_of_mystery(self):
-        return self.scry(1)
-
     def play_zhalfirin_void(self):
         return self.scry(1)
 
@@ -732,8 +1128,3 @@ class GameState(GameStateBase):
             return GameStates()
         return self.add_mana("GGGGGG")
 
-    def sacrifice_devoted_druid(self):
-        return self.add("G")
-
-    def sacrifice_relic_of_progenitus(self):
-        return self.draw(1)
@@ -0,0 +1,89 @@
+"""
+Counters for figuring out which cards and actions blow up the search.
+They're off by default, since they slow things down. Once turned on (see
+state.instrument), each call to one of the busier GameState methods gets
+tallied by method, card, and turn:
+
+- calls: how many times the method was called
+- built: how many GameStates got made along the way, nested calls included
+- returned: how many distinct states came back
+- repeats: how many of those the search had already seen (top-level
+  actions only)
+- dominated: how many got thrown out because another state was at least as
+  good (top-level actions only)
+
+Each process keeps its own counts. Workers hand theirs back with each
+result, and the driver adds them up and writes a report at the end.
+"""
+
+import collections
+import json
+import os
+import time
+
+ENABLED = False
+METRICS = ("calls", "built", "returned", "repeats", "dominated")
+# Map (method, card, turn, metric) to a count.
+COUNTS = collections.Counter()
+
+
+def count(method, card, turn, metric, n=1):
+    COUNTS[method, card, turn, metric] += n
+
+
+def take():
+    """Hand over this process's counts and start again from zero."""
+    counts = dict(COUNTS)
+    COUNTS.clear()
+    return counts
+
+
+class Totals(object):
+    """Counts added up across trials (and processes)."""
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.trials = 0
+
+    def add(self, counts):
+        self.counts.update(counts)
+        self.trials += 1
+
+
+def rows(counts):
+    """One row per method, card, and turn, busiest first."""
+    table = collections.defaultdict(lambda: dict.fromkeys(METRICS, 0))
+    for (method, card, turn, metric), n in counts.items():
+        table[method, card, turn][metric] += n
+    rows = []
+    for (method, card, turn), row in table.items():
+        row = {"method": method, "card": card, "turn": turn, **row}
+        row["branching"] = row["returned"]/row["calls"] if row["calls"] else 0
+        rows.append(row)
+    return sorted(rows, key=lambda x: -x["built"])
+
+
+def write_report(totals):
+    filename = os.path.join("stats", time.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    report = {"trials": totals.trials, "rows": rows(totals.counts)}
+    with open(filename, "w") as handle:
+        json.dump(report, handle, indent=1)
+    return filename
+
+
+def print_summary(counts, n=10):
+    print("%-12s %-28s %4s %8s %8s %9s %8s %9s" % (
+        "method", "card", "turn", "calls", "built", "branching", "repeats", "dominated",
+    ))
+    for row in rows(counts)[:n]:
+        print("%-12s %-28s %4d %8d %8d %9.2f %8d %9d" % (
+            row["method"],
+            row["card"][:28],
+            row["turn"],
+            row["calls"],
+            row["built"],
+            row["branching"],
+            row["repeats"],
+            row["dominated"],
+        ))
@@ -0,0 +1,116 @@
+"""
+Rather than shuffling at random, we can lay out every possible opening
+hand, weighted by how likely it is to be drawn (hypergeometric), and pick
+hands off that list at evenly spaced points. Each distinct hand is a
+stratum. Hands get visited in proportion to their probability, same as
+random shuffles, but we don't waste trials on the luck of which hands
+happen to come up. Only the rest of the deck (and play/draw) is random.
+
+A typical list has something like 150k distinct seven-card hands, so we
+can't afford to search every one. Systematic sampling is the next best
+thing. Hands are listed in a fixed order that keeps similar hands next to
+each other, then n trials pick n evenly spaced hands along that list,
+starting from a random offset.
+"""
+
+import collections
+import math
+import random
+
+from . import manager, output
+
+HAND_SIZE = 7
+
+
+def hands(cardnames, size=HAND_SIZE):
+    """Yield each distinct hand (a tuple of card names) along with the
+    probability of drawing it. Hands come out grouped by how many of each
+    card they have, in order of the deck list.
+    """
+    counts = list(collections.Counter(cardnames).items())
+    total = math.comb(len(cardnames), size)
+
+    def extend(i, room):
+        if i == len(counts):
+            if not room:
+                yield (), 1
+            return
+        name, count = counts[i]
+        for k in range(min(count, room), -1, -1):
+            for rest, ways in extend(i + 1, room - k):
+                yield (name,)*k + rest, math.comb(count, k)*ways
+
+    for hand, ways in extend(0, size):
+        yield hand, ways/total
+
+
+def plan(cardnames, n):
+    """Choose n hands at evenly spaced points along the list of all hands,
+    weighted by probability. Each comes with play/draw, which alternates
+    so that we get half of each.
+    """
+    step = 1/n
+    point = random.random()*step
+    cumulative = 0
+    picks = []
+    for hand, weight in hands(cardnames):
+        cumulative += weight
+        while len(picks) < n and point < cumulative:
+            picks.append(hand)
+            point += step
+    # Floating point error might leave us one short at the very end.
+    while len(picks) < n:
+        picks.append(hand)
+    first = random.randrange(2)
+    return [(hand, bool((i + first) % 2)) for i, hand in enumerate(picks)]
+
+
+def trial(task):
+    name, hand, on_the_play, max_turns, search, use_cache, max_states, max_seconds, retries = task
+    deck_list, kwargs = manager.read_deck(name)
+    library = list(deck_list)
+    for card in hand:
+        library.remove(card)
+    random.shuffle(library)
+    summary, report, performance = manager.play_with_retries(
+        list(hand) + library,
+        dict(kwargs),
+        on_the_play,
+        max_turns,
+        search,
+        use_cache,
+        max_states,
+        max_seconds,
+        retries,
+    )
+    print(name.ljust(12), manager.summarize(summary), performance)
+    return summary
+
+
+def estimate(summaries, turn):
+    """Fraction of trials with titan on or before the given turn, and its
+    standard error. Neighboring picks come from neighboring strata, so
+    treat each pair as a stratum of its own and see how much the two
+    disagree (the successive difference estimator).
+    """
+    hits = [summary["turns"].get(str(turn)) is True for summary in summaries]
+    n = len(hits)
+    mean = sum(hits)/n
+    if n < 2:
+        return mean, 1
+    pairs = zip(hits[0::2], hits[1::2])
+    var = sum((a - b)**2 for a, b in pairs)/(n*n)
+    # With only a few disagreements, the estimate could be zero. Don't
+    # claim to be more precise than if we had a binomial with one hit.
+    var = max(var, 1/(n*n))
+    return mean, math.sqrt(var)
+
+
+def print_estimates(name, summaries, max_turns):
+    line = name.ljust(12)
+    for turn in range(1, max_turns + 1):
+        mean, err = estimate(summaries, turn)
+        overflow = sum(s["turns"].get(str(turn)) is None for s in summaries)
+        line += f"| {output.pct(mean)} ± {output.pct(2*err)} "
+        line += f"({output.pct(overflow/len(summaries))}) "
+    print(line)
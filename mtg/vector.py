@@ -0,0 +1,124 @@
+"""
+At the end of each turn, GameStates.prune_dominated compares every state
+against the others with the same dominance key, one pair at a time. For
+the big frontiers on turns 3 and 4, that's a lot of Python-level
+comparisons. If NumPy is installed, we can lay each group out as arrays
+instead -- a row per state, with a column for each card that might be in
+hand -- and make all the comparisons at once.
+
+Only the comparisons get batched. Expanding states (casting, paying,
+tapping out) branches too irregularly to do as array operations, so that
+still goes through the GameState methods one at a time. Likewise, the
+frontier is already a set, so duplicates are gone before we get here.
+
+NumPy is optional. Without it (or without --numpy), pruning goes through
+the usual GameState.is_dominated.
+
+The two ways of pruning are supposed to keep exactly the same states. To
+make sure, --benchmark --numpy turns on CHECK, which prunes every frontier
+both ways and fails if they disagree.
+"""
+
+import collections
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .mana import GUARD
+
+ENABLED = False
+CHECK = False
+# Below this many states, setting up the arrays costs more than it saves.
+MIN_STATES = 1000
+# Compare this many states at a time against the rest of their group. This
+# keeps the intermediate arrays to a few megabytes.
+BLOCK = 256
+
+
+def available():
+    return np is not None
+
+
+def enable(check=False):
+    global ENABLED, CHECK, MIN_STATES
+    if not available():
+        raise ImportError("pruning with arrays needs NumPy")
+    ENABLED = True
+    if check:
+        CHECK = True
+        # When checking, speed doesn't matter. Look at every frontier.
+        MIN_STATES = 2
+
+
+def prune_dominated(states):
+    """Return the states that no other state dominates. Same result as
+    GameStates.prune_dominated.
+    """
+    groups = collections.defaultdict(list)
+    for state in states:
+        groups[state.dominance_key()].append(state)
+    kept = []
+    for group in groups.values():
+        if len(group) == 1:
+            kept.extend(group)
+        else:
+            kept.extend(x for x, keep in zip(group, undominated(group)) if keep)
+    return kept
+
+
+def check(states, expected):
+    """Prune the states with arrays, and make sure that keeps the same ones
+    as pruning them a pair at a time did. Return them.
+    """
+    kept = set(prune_dominated(states))
+    if kept != set(expected):
+        raise AssertionError(
+            f"pruning {len(states)} states with arrays kept {len(kept)}, "
+            f"pairwise kept {len(expected)}"
+        )
+    return expected
+
+
+def undominated(group):
+    """For each state in the group, whether it's safe from all the others.
+    The states are distinct, and two distinct states with the same
+    dominance key can't dominate each other, so there are no ties to break.
+    The comparisons match GameState.dominates.
+    """
+    n = len(group)
+    guard = np.int64(GUARD)
+    pools = np.array([int(x.mana_pool) for x in group], dtype=np.int64)
+    debts = np.array([int(x.mana_debt) for x in group], dtype=np.int64)
+    drops = np.array([x.land_drops for x in group], dtype=np.int64)
+    hands = hand_counts(group)
+    keep = np.ones(n, dtype=bool)
+    for start in range(0, n, BLOCK):
+        rows = slice(start, min(start + BLOCK, n))
+        # dominated[i, j] says whether state j dominates state start+i. See
+        # Mana.__ge__ for how the guard bits compare all colors at once.
+        dominated = (
+            ((((pools[None, :] | guard) - pools[rows, None]) & guard) == guard) &
+            ((((debts[rows, None] | guard) - debts[None, :]) & guard) == guard) &
+            (drops[None, :] >= drops[rows, None]) &
+            (hands[None, :, :] >= hands[rows, None, :]).all(axis=2)
+        )
+        # Everything dominates itself.
+        size = rows.stop - rows.start
+        dominated[np.arange(size), np.arange(rows.start, rows.stop)] = False
+        keep[rows] = ~dominated.any(axis=1)
+    return keep
+
+
+def hand_counts(group):
+    """One row per state, one column per card, counting copies in hand."""
+    columns = {}
+    for state in group:
+        for card in state.hand:
+            columns.setdefault(card, len(columns))
+    counts = np.zeros((len(group), max(len(columns), 1)), dtype=np.int8)
+    for i, state in enumerate(group):
+        for card in state.hand:
+            counts[i, columns[card]] += 1
+    return counts